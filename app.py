@@ -1,29 +1,107 @@
+import csv
+import io
+import json
+import logging
 import re
-import traceback
+import zlib
 from collections import Counter, defaultdict
 from datetime import datetime, timedelta, timezone
 from functools import wraps
+from hmac import compare_digest
 from os.path import splitext
+from time import perf_counter
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-import requests
-from flask import Flask, Response, make_response, redirect, render_template, request, url_for
+from flask import Flask, Response, g, make_response, redirect, render_template, request, send_file, url_for
 from twilio.twiml.voice_response import Gather, VoiceResponse
 
-from storage import CallLog, CodedMessages, Config, Contacts, Cookies, IdNumbers, Ignored, OpenHours, Secrets
+import metrics
+import profiling
+from maintenance import Maintenance
+from storage import (CallLog, CallVolume, CodedMessages, Config, Contacts, Cookies, IdNumbers, Ignored, OpenHours,
+                     Secrets, Storage, WelcomeOutbox, audio_path, bootstrap, enable_group_commit)
+from welcome import WelcomeSender
 
 app = Flask(__name__)
 
+metrics.instrument_storage(Storage)
+bootstrap()
+
 SECRETS = Secrets()
 IGNORED = Ignored()
 CALL_LOG = CallLog()
+CALL_VOLUME = CallVolume()
 COOKIES = Cookies()
 CODED = CodedMessages()
 CONFIG = Config()
 OPEN_HOURS = OpenHours()
 CONTACTS = Contacts()
-ID_NUMBERS = IdNumbers()
+ID_NUMBERS = IdNumbers(cache=True)
+WELCOME_OUTBOX = WelcomeOutbox()
+WELCOME_SENDER = WelcomeSender(WELCOME_OUTBOX, SECRETS)
+MAINTENANCE = Maintenance(COOKIES, app.logger)
+
+if CONFIG.get('group_commit_window'):
+    enable_group_commit(float(CONFIG['group_commit_window']))
+
+if CONFIG.get('sql_profile_ms'):
+    profiling.enable(float(CONFIG['sql_profile_ms']) / 1000)
+
+DEFAULT_TIMEZONE = 'America/Los_Angeles'
+TIMEZONE = None  # (ZoneInfo, CONFIG.CHANGES value it was read at); see line_timezone()
+
+# Done with the database at import. A server that forks workers after importing must not hand them this connection.
+Storage.close_connection()
+
+# Rendered webhook responses, keyed on everything they depend on besides the stored messages.
+TWIML_CACHE = {}
+TWIML_CACHE_GENERATION = 0
+TWIML_CACHE_CHANGES = None  # CODED.CHANGES when the cache was last cleared; other workers' edits move it
+TWIML_CACHE_SIZE = 1024
+
+ID_REGEX = None  # (compiled regex or None, SECRETS.CHANGES value it was read at); see id_regex()
+
+CALL_LOG_PAGE_SIZE = 100
+VOLUME_RECENT_HOURS = 48
+VOLUME_TOP_CODES = 10
+
+
+@app.before_request
+def start_workers():
+    # started here rather than at import, so each forked worker process gets its own threads
+    WELCOME_SENDER.start()  # also picks up messages left queued by a previous run
+    MAINTENANCE.start()
+
+
+@app.before_request
+def start_timer():
+    g.request_start = perf_counter()
+    if profiling.enabled():
+        profiling.start()
+
 
-PACIFIC_TIME = timezone(timedelta(hours=-7))
+@app.after_request
+def report_sql_profile(response):
+    profile = profiling.finish()
+    if profile is not None:
+        summary = profiling.summary(profile)
+        response.headers['X-SQL-Profile'] = summary
+        slow = any(statement.plan for statement in profile)
+        app.logger.log(logging.WARNING if slow else logging.INFO, 'SQL %s %s: %s | %s', request.method,
+                       request.path, summary, ' | '.join(statement.describe() for statement in profile))
+    return response
+
+
+@app.teardown_request
+def record_latency(exception):
+    if 'request_start' in g:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.REQUEST_LATENCY.observe(perf_counter() - g.request_start, route, request.method)
+
+
+@app.teardown_appcontext
+def close_connection(exception):
+    Storage.close_connection()
 
 
 def authenticated(route):
@@ -56,46 +134,225 @@ def analytics():
             else:
                 IGNORED.remove(number)
                 success = 'Removed {} from ignored numbers.'.format(number)
-
-    table = CALL_LOG.filter_ignored()
-    uniques = len(set(row[0] for row in table))
-    code_counter = sorted(tuple(Counter(row[2] for row in table if row[2] is not None).items()),
+        elif 'file' in request.files:  # importing ignored numbers:
+            def parse(row):
+                number = row[0].strip() if row else ''
+                return number if number.startswith('+') else None
+
+            success, error = import_csv(('number',), parse, IGNORED.add_many)
+
+    filters, filter_error = call_filters()
+    error = error or filter_error
+    before = None
+    if request.args.get('before'):
+        try:
+            timestamp, id_ = request.args['before'].split('.')
+            before = (int(timestamp), int(id_))
+        except ValueError:  # also raised for the wrong number of parts
+            error = error or 'Invalid page.'
+    table = CALL_LOG.page(before=before, limit=CALL_LOG_PAGE_SIZE + 1, **filters)
+    next_page = None
+    if len(table) > CALL_LOG_PAGE_SIZE:
+        table = table[:CALL_LOG_PAGE_SIZE]
+        next_page = '{}.{}'.format(table[-1][2], table[-1][0])
+    total_calls, uniques, code_stats = CALL_LOG.stats()
+    code_counter = sorted(((code, uses) for code, (uses, _) in code_stats.items()),
                           key=lambda tup: (tup[1], tup[0]), reverse=True)
-    return render_template('analytics.html', table=table, uniques=uniques, ignored=IGNORED, error=error,
-                           success=success, code_counter=code_counter, unique_codes=count_unique_code_usages(table),
-                           contacts=CONTACTS)
+    unique_codes = {code: code_callers for code, (_, code_callers) in code_stats.items()}
+    return render_template('analytics.html', table=table, total_calls=total_calls, uniques=uniques, ignored=IGNORED,
+                           error=error, success=success, code_counter=code_counter, unique_codes=unique_codes,
+                           next_page=next_page, filter_args=filter_args())
 
 
-def count_unique_code_usages(table):
-    temp = defaultdict(set)
-    for number, _, code, __ in table:
-        temp[code].add(number)
-    return {key: len(value) for key, value in temp.items()}
+@app.route('/analytics/export', methods=['GET'])
+@authenticated
+def export_calls():
+    """Stream the call log as CSV or NDJSON, optionally gzipped, using the same filters as /analytics."""
+    filters, error = call_filters()
+    if error:
+        return error, 400
+    format_ = request.args.get('format', 'csv')
+    if format_ not in EXPORT_FORMATS:
+        return 'Unknown format {!r}.'.format(format_), 400
+    serialize, mimetype = EXPORT_FORMATS[format_]
+    header = ('number', 'name', 'time', 'code', 'id_number')
+    rows = ((number, name, export_time(timestamp), code, id_num)
+            for number, name, timestamp, code, id_num in CALL_LOG.export(**filters))
+    return export_response(serialize(header, rows), 'calls.' + format_, mimetype)
+
+
+@app.route('/analytics/ignored/export', methods=['GET'])
+@authenticated
+def export_ignored():
+    rows = [(number,) for number in IGNORED]  # read up front, as in export_ids
+    return export_response(csv_chunks(('number',), rows), 'ignored.csv', 'text/csv')
+
+
+def export_time(timestamp):
+    if isinstance(timestamp, int):
+        return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
+    return timestamp  # a legacy row the migration couldn't parse
+
+
+def export_response(chunks, file_name, mimetype):
+    """Stream text chunks as a file download, gzipped if the query string asks for it."""
+    body = (chunk.encode() for chunk in chunks)
+    if request.args.get('gzip'):
+        body = gzip_chunks(body)
+        file_name += '.gz'
+        mimetype = 'application/gzip'
+    resp = Response(body, mimetype=mimetype)
+    resp.headers['Content-Disposition'] = 'attachment; filename={}'.format(file_name)
+    return resp
+
+
+def import_csv(header, parse, store):
+    """Import the CSV file uploaded as `file`, streaming it into `store` in a single call.
+
+    `parse` turns a row into the value to store, or None to reject it. A first row matching `header` is skipped.
+    Returns (success message, error message).
+    """
+    file = request.files.get('file')
+    if not file or not file.filename:
+        return '', 'No file provided.'
+    rows = csv.reader(io.TextIOWrapper(file.stream, encoding='utf-8-sig', newline=''))
+    tally = Counter()
+
+    def values():
+        for line, row in enumerate(rows):
+            if line == 0 and tuple(cell.strip().lower() for cell in row) == header:
+                continue
+            value = parse(row)
+            if value is None:
+                tally['rejected'] += 1
+            else:
+                tally['accepted'] += 1
+                yield value
+
+    try:
+        inserted = store(values())
+    except UnicodeDecodeError:
+        Storage.connection().rollback()  # nothing from a half-read file is kept
+        return '', 'The file must be UTF-8 encoded CSV.'
+    except csv.Error as e:
+        Storage.connection().rollback()
+        return '', "The file isn't valid CSV: {}".format(e)
+    return ('Imported {}: {} inserted, {} skipped, {} rejected.'.format(
+        file.filename, inserted, tally['accepted'] - inserted, tally['rejected']), '')
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)  # gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def csv_chunks(header, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def ndjson_chunks(header, rows):
+    lines = []
+    size = 0
+    for row in rows:
+        line = json.dumps(dict(zip(header, row))) + '\n'
+        lines.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield ''.join(lines)
+            lines = []
+            size = 0
+    yield ''.join(lines)
+
+
+EXPORT_FORMATS = {
+    'csv': (csv_chunks, 'text/csv'),
+    'ndjson': (ndjson_chunks, 'application/x-ndjson'),
+}
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+@app.route('/analytics/volume', methods=['GET'])
+@authenticated
+def call_volume():
+    try:
+        days = max(1, min(int(request.args.get('days', 28)), 3660))
+    except ValueError:
+        return 'days must be a whole number.', 400
+    now = int(datetime.now().timestamp())
+    end_hour = now // 3600 + 1
+    rows = CALL_VOLUME.hours(end_hour - days * 24, end_hour, now)
+
+    hourly = Counter()
+    daily = Counter()
+    weekly = Counter()
+    daily_codes = defaultdict(Counter)
+    code_totals = Counter()
+    recent = end_hour - VOLUME_RECENT_HOURS
+    for hour, code, calls in rows:
+        local = datetime.fromtimestamp(hour * 3600, tz=line_timezone())
+        if hour >= recent:
+            hourly[local.replace(minute=0, second=0)] += calls
+        daily[local.date()] += calls
+        weekly[local.weekday(), local.hour] += calls
+        if code:
+            daily_codes[local.date()][code] += calls
+            code_totals[code] += calls
+    top_codes = [code for code, _ in code_totals.most_common(VOLUME_TOP_CODES)]
+    return render_template('volume.html', days=days, hourly=sorted(hourly.items()), daily=sorted(daily.items()),
+                           weekly=weekly, daily_codes=daily_codes, top_codes=top_codes)
+
+
+def call_filters():
+    """Read call log filters from the query string. Returns (filters for CallLog, error message)."""
+    error = ''
+    filters = {'number': request.args.get('number') or None,
+               'code': request.args.get('code') or None}
+    try:
+        if request.args.get('start'):
+            filters['start'] = local_midnight(request.args['start'])
+        if request.args.get('end'):  # inclusive, so count up to the start of the next day
+            filters['end'] = local_midnight(request.args['end'], days=1)
+    except ValueError:
+        error = 'Dates must look like 2020-01-31.'
+    return filters, error
+
+
+def local_midnight(day, days=0):
+    """Unix time of the start of `day` ('YYYY-MM-DD'), plus `days` days, in the line's time zone."""
+    midnight = datetime.strptime(day, '%Y-%m-%d') + timedelta(days=days)
+    return int(midnight.replace(tzinfo=line_timezone()).timestamp())
+
+
+def filter_args():
+    """The call log filters in the query string, for building links to other pages."""
+    return {key: request.args[key] for key in ('number', 'code', 'start', 'end') if request.args.get(key)}
+
+
+@app.template_filter('call_time')
+def format_call_time(timestamp):
+    if isinstance(timestamp, int):
+        return datetime.fromtimestamp(timestamp, tz=line_timezone()).strftime('%c')
+    return timestamp  # a legacy row the migration couldn't parse
 
 
 def log_request():
     if request.method == 'POST' and {'Caller', 'CallSid'}.issubset(request.values):
         if not CALL_LOG.has_called(request.values['Caller']):
-            send_welcome_message(request.values['Caller'])
-        CALL_LOG.add(request.values['Caller'], datetime.now().strftime('%c'), request.values['CallSid'])
-
-
-def send_welcome_message(phone_num):
-    try:
-        url = SECRETS['welcome_url']
-        exchange = SECRETS['welcome_exchange_name']
-        password = SECRETS['welcome_system_password']
-    except KeyError:
-        return
-    if not all((url, exchange, password)):
-        return
-    try:
-        requests.post(url, data={'phone_num': phone_num,
-                                 'exchange': exchange,
-                                 'password': password})
-    except requests.exceptions.RequestException as e:
-        traceback.print_exc()
-        return
+            WELCOME_SENDER.enqueue(request.values['Caller'])
+        CALL_LOG.add(request.values['Caller'], int(datetime.now().timestamp()), request.values['CallSid'])
 
 
 @app.route('/configure_welcome', methods=['GET'])
@@ -104,7 +361,7 @@ def configure_welcome():
     welcome_data = {'url': SECRETS.get('welcome_url'),
                     'exchange': SECRETS.get('welcome_exchange_name'),
                     'password': SECRETS.get('welcome_system_password')}
-    return render_template('configure_welcome.html', welcome_data=welcome_data)
+    return render_template('configure_welcome.html', welcome_data=welcome_data, dead=WELCOME_OUTBOX.dead())
 
 
 @app.route('/configure_welcome', methods=['POST'])
@@ -157,21 +414,47 @@ def add_contact():
     name = request.values.get('name')
     if not number or not name:
         return 'Name and number are required!', 400
+    CONTACTS[normalize_number(number)] = name
+    return redirect(url_for('contacts'))
+
+
+def normalize_number(number):
     number = ''.join(s for s in number if s.isnumeric())
     if len(number) == 10:
         number = '1' + number
-    number = '+' + number
-    CONTACTS[number] = name
-    return redirect(url_for('contacts'))
+    return '+' + number
+
+
+@app.route('/contacts/import', methods=['POST'])
+@authenticated
+def import_contacts():
+    def parse(row):
+        if len(row) < 2 or not row[0].strip() or not row[1].strip():
+            return None
+        return normalize_number(row[0]), row[1].strip()
+
+    success, error = import_csv(('number', 'name'), parse, CONTACTS.update)
+    return render_template('contacts.html', contacts=CONTACTS, success=success, error=error)
+
+
+@app.route('/contacts/export', methods=['GET'])
+@authenticated
+def export_contacts():
+    rows = list(CONTACTS)  # read up front, as in export_ids
+    return export_response(csv_chunks(('number', 'name'), rows), 'contacts.csv', 'text/csv')
 
 
 @app.route('/answer', methods=['GET', 'POST'])
 def voice():
     """Respond to incoming phone calls."""
     log_request()
+    open_ = is_open()
+    return cached_twiml(('voice', open_), lambda: build_voice(open_))
 
+
+def build_voice(open_):
     resp = VoiceResponse()
-    if is_open():
+    if open_:
         if 'prompt' in CODED:
             gather = Gather(action=url_for('answer_digits'))
             add_message(gather, 'prompt')
@@ -186,35 +469,81 @@ def voice():
             else:
                 gather = resp
             add_message(gather, 'closed')
-    return str(resp)
+    return resp
+
+
+def cached_twiml(key, build):
+    """Return the rendered TwiML for `key`, calling `build` to make the response on a miss.
+
+    `key` must capture everything the response depends on besides the stored messages. Edits in this process call
+    invalidate_twiml; edits in other processes are noticed through CODED.CHANGES.
+    """
+    global TWIML_CACHE_CHANGES
+    changes = CODED.CHANGES.current()
+    if changes != TWIML_CACHE_CHANGES:
+        invalidate_twiml()
+        TWIML_CACHE_CHANGES = changes
+    key = (request.script_root,) + key
+    try:
+        return TWIML_CACHE[key]
+    except KeyError:
+        pass
+    generation = TWIML_CACHE_GENERATION
+    twiml = str(build()).encode()
+    if generation == TWIML_CACHE_GENERATION:  # don't cache a response built from messages edited meanwhile
+        if len(TWIML_CACHE) >= TWIML_CACHE_SIZE:
+            TWIML_CACHE.clear()
+        TWIML_CACHE[key] = twiml
+    return twiml
+
+
+def invalidate_twiml():
+    """Forget all rendered TwiML. Call after any change to coded messages."""
+    global TWIML_CACHE_GENERATION
+    TWIML_CACHE_GENERATION += 1
+    TWIML_CACHE.clear()
+
+
+def line_timezone():
+    """Return the line's time zone. Re-read when the config changes, in this process or another."""
+    global TIMEZONE
+    changes = CONFIG.CHANGES.current()
+    if TIMEZONE is None or TIMEZONE[1] != changes:
+        TIMEZONE = (ZoneInfo(CONFIG.get('timezone') or DEFAULT_TIMEZONE), changes)
+    return TIMEZONE[0]
 
 
 def is_open():
-    now = datetime.now(tz=PACIFIC_TIME)
-    open_, close = OPEN_HOURS.get(now.weekday())
-    if None in (open_, close):
-        return True
-    now_str = now.strftime('%H:%M')
-    return open_ <= now_str < close
+    return OPEN_HOURS.schedule().is_open(datetime.now(tz=line_timezone()))
 
 
 @app.route('/answer/audio.mp3', methods=['GET', 'POST'])
 def answer_audio():
     digits = request.values.get('code', '')
-    audio = CODED.get_response_audio(digits)
-    if not isinstance(audio, bytes):
+    message = CODED.get_response_audio_info(digits)
+    if message is None:
+        return ''
+    try:
+        # send_file hands the file to the server's wsgi.file_wrapper (sendfile) and handles ranges and 304s.
+        resp = send_file(audio_path(message.audio_hash), mimetype='audio/mpeg', etag=message.audio_hash,
+                         last_modified=message.audio_modified, max_age=None)
+    except FileNotFoundError:  # replaced since it was looked up
         return ''
-    return Response(audio, mimetype='audio/mpeg')
+    resp.cache_control.public = True
+    resp.cache_control.no_cache = True  # recordings can be replaced, so revalidate; that's a cheap 304
+    return resp
 
 
 @app.route('/answer/digits', methods=['GET', 'POST'])
 def answer_digits():
     """Respond to a call with a special message."""
     log_digits()
-    resp = VoiceResponse()
-
     digits = request.values.get('Digits', '')
+    return cached_twiml(('digits', digits), lambda: build_digits(digits))
 
+
+def build_digits(digits):
+    resp = VoiceResponse()
     message_options = get_options(CODED.get_options(digits))
     require_id = message_options.get('require_id')
     register_id = message_options.get('register_id')
@@ -225,7 +554,7 @@ def answer_digits():
         resp.append(gather)
     else:
         add_message(resp, digits)
-    return str(resp)
+    return resp
 
 
 @app.route('/answer/id', methods=['GET', 'POST'])
@@ -233,32 +562,49 @@ def answer_id():
     """Respond to a call by prompting for an ID number."""
     log_id()
 
-    resp = VoiceResponse()
     id_num = request.values.get('Digits', '')
     digits = request.values.get('original_digits', '')
     require_id = request.values.get('require_id', '') == 'True'
     register_id = request.values.get('register_id', '') == 'True'
 
+    codes = ()
     if register_id:
         if check_new_id(id_num):
             ID_NUMBERS.add(id_num)
-            add_message(resp, 'good-id')
-            add_message(resp, digits)
+            codes = ('good-id', digits)
         else:
-            add_message(resp, 'bad-id')
+            codes = ('bad-id',)
     elif require_id:
         if id_num in ID_NUMBERS:
-            add_message(resp, digits)  # this isn't secure because audio can be accessed directly at URL by anyone.
+            codes = (digits,)  # this isn't secure because audio can be accessed directly at URL by anyone.
         else:
-            add_message(resp, 'unknown-id')
-    return str(resp)
+            codes = ('unknown-id',)
+    return cached_twiml(('id',) + codes, lambda: build_messages(codes))
+
+
+def build_messages(codes):
+    resp = VoiceResponse()
+    for code in codes:
+        add_message(resp, code)
+    return resp
 
 
 def check_new_id(id_num):
-    id_regex = SECRETS.get('id_regex')
-    if id_regex is None:
+    regex = id_regex()
+    if regex is None:
         return True
-    return re.match(id_regex, id_num)
+    return regex.match(id_num)
+
+
+def id_regex():
+    """Return the compiled ID regex, or None if new IDs aren't checked. Re-read when the secrets change, in this
+    process or another."""
+    global ID_REGEX
+    changes = SECRETS.CHANGES.current()
+    if ID_REGEX is None or ID_REGEX[1] != changes:
+        source = SECRETS.get('id_regex')
+        ID_REGEX = (None if source is None else re.compile(source), changes)
+    return ID_REGEX[0]
 
 
 def add_message(thing, code):
@@ -299,6 +645,7 @@ def edit_message():
             success = 'The new text message has been set.'
         else:
             error = 'Unknown response type {!r}.'.format(request.values.get('type'))
+        invalidate_twiml()
     return render_template('editor.html', coded_messages=CODED, success=success, error=error)
 
 
@@ -352,6 +699,7 @@ def edit_prompt():
             success = 'The prompt has been removed.'
         else:
             error = 'Unknown response type {!r}.'.format(request.values.get('type'))
+        invalidate_twiml()
     return render_template('prompt-editor.html', coded_messages=CODED, success=success, error=error)
 
 
@@ -361,6 +709,7 @@ def delete_code_response():
     code = request.values.get('code')
     if code:
         CODED.delete_reponse(code)
+        invalidate_twiml()
     return redirect(url_for('edit_message'))
 
 
@@ -373,7 +722,8 @@ def open_hours():
             (i, None, None)
             for i in range(7)
         )
-    return render_template('open_hours.html', time_table=time_table)
+    return render_template('open_hours.html', time_table=time_table, overrides=OPEN_HOURS.overrides(),
+                           timezone=line_timezone().key)
 
 
 @app.route('/open_hours', methods=['POST'])
@@ -387,6 +737,44 @@ def update_open():
     return redirect(url_for('open_hours'))
 
 
+@app.route('/open_hours/timezone', methods=['POST'])
+@authenticated
+def set_timezone():
+    name = request.values.get('timezone', '').strip()
+    try:
+        ZoneInfo(name)
+    except (ValueError, ZoneInfoNotFoundError):
+        return 'Unknown time zone {!r}. Use a name like America/Los_Angeles.'.format(name), 400
+    CONFIG['timezone'] = name
+    return redirect(url_for('open_hours'))
+
+
+@app.route('/open_hours/overrides', methods=['POST'])
+@authenticated
+def add_open_override():
+    try:
+        # stored in one canonical form, since the schedule parses it with date.fromisoformat
+        day = datetime.strptime(request.values.get('date', ''), '%Y-%m-%d').date().isoformat()
+    except ValueError:
+        return 'Error! Dates must look like 2020-12-25.', 400
+    if request.values.get('closed', 'off') == 'on':
+        OPEN_HOURS.set_override(day)
+    else:
+        open_ = request.values.get('open', '')
+        close = request.values.get('close', '')
+        if not (validate_time(open_) and validate_time(close) and close >= open_):
+            return 'Error! The closing must be later than the opening!', 400
+        OPEN_HOURS.set_override(day, open_, close)
+    return redirect(url_for('open_hours'))
+
+
+@app.route('/open_hours/overrides/delete', methods=['POST'])
+@authenticated
+def delete_open_override():
+    OPEN_HOURS.remove_override(request.values.get('date', ''))
+    return redirect(url_for('open_hours'))
+
+
 def validate_open():
     for i in range(7):
         open_ = request.values.get('open-{}'.format(i))
@@ -413,11 +801,39 @@ def id_management():
     return render_template('id_management.html', id_numbers=iter(ID_NUMBERS), id_regex=SECRETS.get('id_regex'))
 
 
+@app.route('/ids/import', methods=['POST'])
+@authenticated
+def import_ids():
+    regex = id_regex()
+
+    def parse(row):
+        id_num = row[0].strip() if row else ''
+        if not id_num or (regex is not None and not regex.match(id_num)):
+            return None
+        return id_num
+
+    success, error = import_csv(('id_number',), parse, ID_NUMBERS.add_many)
+    return render_template('id_management.html', id_numbers=iter(ID_NUMBERS), id_regex=SECRETS.get('id_regex'),
+                           success=success, error=error)
+
+
+@app.route('/ids/export', methods=['GET'])
+@authenticated
+def export_ids():
+    # read up front: the request's connection is closed before a streamed body is sent
+    rows = [(id_num,) for id_num in ID_NUMBERS]
+    return export_response(csv_chunks(('id_number',), rows), 'ids.csv', 'text/csv')
+
+
 @app.route('/ids/set_regex', methods=['POST'])
 @authenticated
 def set_id_regex():
     regex = request.values.get('regex')
     if regex:
+        try:
+            re.compile(regex)
+        except re.error as e:
+            return 'Invalid regular expression: {}'.format(e), 400
         SECRETS['id_regex'] = regex
     else:
         del SECRETS['id_regex']
@@ -430,7 +846,6 @@ def log_in():
         return redirect(request.values.get('dest') or url_for('edit_message'))
 
     if request.method == 'GET':
-        COOKIES.prune()
         return render_template('auth.html')
     elif request.values.get('pw', '') == SECRETS['password']:
         resp = make_response(redirect(request.values.get('dest') or url_for('edit_message')))
@@ -448,6 +863,16 @@ def log_out():
     return redirect(url_for('log_in'))
 
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    # Scrapers can't log in, so this is open unless a `metrics_token` secret is set, in which case it's required
+    # as a bearer token.
+    token = SECRETS.get('metrics_token')
+    if token and not compare_digest(request.headers.get('Authorization', ''), 'Bearer {}'.format(token)):
+        return Response('Unauthorized.\n', status=401, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/hacker.css', methods=['GET'])
 def main_theme():
     return Response(render_template('hacker.css', main_color=CONFIG.get('main_color', '#00ff00')), mimetype='text/css')
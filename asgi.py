@@ -0,0 +1,121 @@
+"""ASGI entry point, for serving the app from an async server such as uvicorn (`uvicorn asgi:app`).
+
+Requests are still handled by the Flask app, on a bounded thread pool, so the TwiML is exactly what the WSGI server
+returns; the event loop only holds connections while they wait for a thread. Welcome messages are already sent from
+a background thread (see welcome.py), so no webhook waits on an outbound HTTP call.
+"""
+import asyncio
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from app import app as flask_app
+
+MAX_THREADS = int(os.environ.get('TWILIO_ASGI_THREADS') or 16)
+
+
+class WsgiBridge:
+    """Serve a WSGI app over ASGI, running it on at most `max_threads` threads."""
+
+    def __init__(self, wsgi_app, max_threads=MAX_THREADS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type {!r}.'.format(scope['type']))
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._handle, scope, b''.join(body), send, loop)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _handle(self, scope, body, send, loop):
+        """Run the WSGI app on this worker thread, sending the response back through the event loop."""
+        def emit(message):
+            # waiting for each send also stops a slow client from making us buffer the whole response
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('started'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+            return write
+
+        def start():
+            if not response.get('started'):
+                response['started'] = True
+                emit({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+
+        def write(data):
+            start()
+            emit({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+        result = self.wsgi_app(_environ(scope, body), start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    write(chunk)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        start()
+        emit({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+def _environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    # The body was read in full, and a chunked or HTTP/2 request may not have said how long it was.
+    environ['CONTENT_LENGTH'] = str(len(body))
+    environ.pop('HTTP_TRANSFER_ENCODING', None)
+    return environ
+
+
+app = WsgiBridge(flask_app)
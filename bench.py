@@ -0,0 +1,245 @@
+"""Benchmark the Twilio webhook flow: /answer, then /answer/digits, then /answer/id when the code asks for an ID.
+
+Seeds a scratch database, drives the app with synthetic Twilio POSTs through Flask's test client and reports p50/p99
+latency, requests per second and queries per request for each route. It then starts fresh interpreters against the
+same database to time cold starts: importing the app and serving the first call. Results are saved as JSON so runs
+can be compared:
+
+    python bench.py --output before.json
+    python bench.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import defaultdict
+from time import perf_counter, time
+
+ROUTES = ('/answer', '/answer/digits', '/answer/id')
+
+# Run in a new interpreter for each cold start; prints its timings as JSON.
+STARTUP_SCRIPT = """
+import json, sys
+from time import perf_counter
+start = perf_counter()
+sys.path.insert(0, sys.argv[1])
+import app
+imported = perf_counter()
+app.app.test_client().post('/answer', data={'Caller': '+15550000000', 'CallSid': 'CAstartup' + sys.argv[2]})
+print(json.dumps({'import': imported - start, 'first_request': perf_counter() - imported}))
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=100000, help='calls already in the call log')
+    parser.add_argument('--contacts', type=int, default=1000)
+    parser.add_argument('--codes', type=int, default=200, help='coded messages; every tenth one requires an ID')
+    parser.add_argument('--ids', type=int, default=10000, help='registered ID numbers')
+    parser.add_argument('--requests', type=int, default=3000, help='simulated calls to run')
+    parser.add_argument('--threads', type=int, default=1, help='calls to run concurrently')
+    parser.add_argument('--startup-runs', type=int, default=10, help='cold starts to time')
+    parser.add_argument('--group-commit', type=float, metavar='WINDOW', help='enable group commit with this window')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', metavar='FILE', help='earlier results to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help='exit with an error if any p99 got worse by more than this fraction')
+    return parser.parse_args()
+
+
+def seed(path, args, rng):
+    """Fill the app's (already created and migrated) tables with synthetic data."""
+    conn = sqlite3.connect(path)
+    now = int(time())
+    conn.executemany('INSERT INTO calls (number, timestamp, call_sid, code) VALUES (?, ?, ?, ?)',
+                     ((caller(rng, args), now - rng.randrange(365 * 24 * 60 * 60), 'CAseed{}'.format(i),
+                       str(rng.randrange(args.codes)) if rng.random() < 0.8 else None)
+                      for i in range(args.calls)))
+    conn.executemany('INSERT OR IGNORE INTO contacts VALUES (?, ?)',
+                     ((caller(rng, args), 'Contact {}'.format(i)) for i in range(args.contacts)))
+    conn.executemany('INSERT INTO coded_messages (code, use_text, text_, options) VALUES (?, 1, ?, ?)',
+                     [('', 'Default message.', 0), ('prompt', 'Enter your code.', 0),
+                      ('id-prompt', 'Enter your ID.', 0), ('unknown-id', 'Unknown ID.', 0)] +
+                     [(str(code), 'Message {}.'.format(code), 1 if code % 10 == 0 else 0)
+                      for code in range(args.codes)])
+    conn.executemany('INSERT INTO id_numbers VALUES (?)', ((str(100000 + i),) for i in range(args.ids)))
+    conn.commit()
+    conn.close()
+
+
+def caller(rng, args):
+    return '+1555{:07d}'.format(rng.randrange(max(args.calls // 10, 1)))
+
+
+class QueryCounter:
+    """Counts statements per thread through a trace callback on every connection.
+
+    Transaction control isn't counted. SQLite traces a statement again for each trigger it fires, so immediate
+    repeats are only counted once.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def install(self, conn):
+        conn.set_trace_callback(self._statement)
+
+    def _statement(self, statement):
+        if statement.strip() in ('BEGIN', 'COMMIT') or statement == getattr(self._local, 'last', None):
+            return
+        self._local.last = statement
+        self._local.count = getattr(self._local, 'count', 0) + 1
+
+    def take(self):
+        count = getattr(self._local, 'count', 0)
+        self._local.count = 0
+        self._local.last = None
+        return count
+
+
+def run_calls(app, count, args, rng, queries, results):
+    client = app.test_client()
+    for i in range(count):
+        call_sid = 'CAbench{}-{}'.format(threading.get_ident(), i)
+        code = str(rng.randrange(args.codes))
+        steps = [('/answer', {'Caller': caller(rng, args), 'CallSid': call_sid}),
+                 ('/answer/digits', {'Digits': code, 'CallSid': call_sid})]
+        if int(code) % 10 == 0:
+            id_num = str(100000 + rng.randrange(args.ids * 2))  # half of these are unknown
+            steps.append(('/answer/id?original_digits={}&require_id=True&register_id=False'.format(code),
+                          {'Digits': id_num, 'CallSid': call_sid}))
+        for url, data in steps:
+            queries.take()
+            start = perf_counter()
+            resp = client.post(url, data=data)
+            elapsed = perf_counter() - start
+            if resp.status_code != 200:
+                raise RuntimeError('{} returned {}'.format(url, resp.status_code))
+            results[url.split('?')[0]].append((elapsed, queries.take()))
+
+
+def time_startups(runs):
+    """Start `runs` new interpreters that import the app and serve one call. Returns their timings in seconds."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    timings = []
+    for run in range(runs):
+        start = perf_counter()
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, here, str(run)], check=True,
+                                capture_output=True, text=True).stdout
+        timing = json.loads(output.splitlines()[-1])
+        timing['process'] = perf_counter() - start
+        timings.append(timing)
+    return timings
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(results, wall_time, startups):
+    summary = {}
+    for route in ROUTES:
+        samples = results.get(route)
+        if not samples:
+            continue
+        latencies = [elapsed for elapsed, _ in samples]
+        summary[route] = {
+            'requests': len(samples),
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            'queries_per_request': round(sum(count for _, count in samples) / len(samples), 2),
+        }
+    total = sum(len(samples) for samples in results.values())
+    summary['all'] = {'requests': total, 'requests_per_second': round(total / wall_time, 1)}
+    if startups:
+        summary['startup'] = {'runs': len(startups)}
+        for key in ('import', 'first_request', 'process'):
+            summary['startup'][key + '_p50_ms'] = round(percentile([t[key] for t in startups], 0.5) * 1000, 1)
+    return summary
+
+
+def compare(summary, baseline, max_regression):
+    """Print the change from `baseline` and return False if any route's p99 regressed too far."""
+    ok = True
+    for route in ROUTES:
+        if route not in summary or route not in baseline:
+            continue
+        before, after = baseline[route]['p99_ms'], summary[route]['p99_ms']
+        change = (after - before) / before if before else 0
+        flag = ''
+        if change > max_regression:
+            ok = False
+            flag = '  REGRESSION'
+        print('{:<16} p99 {:8.3f} -> {:8.3f} ms ({:+.0%}), queries {} -> {}{}'.format(
+            route, before, after, change, baseline[route]['queries_per_request'],
+            summary[route]['queries_per_request'], flag))
+    before, after = baseline['all']['requests_per_second'], summary['all']['requests_per_second']
+    print('{:<16} {} -> {} requests/s'.format('all', before, after))
+    if 'startup' in summary and 'startup' in baseline:
+        print('{:<16} {} -> {} ms to start and serve the first call'.format(
+            'startup', baseline['startup']['process_p50_ms'], summary['startup']['process_p50_ms']))
+    return ok
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    directory = tempfile.mkdtemp(prefix='twilio-bench-')
+    os.environ['TWILIO_DATA_PATH'] = os.path.join(directory, 'twilio_data.sqlite')
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import storage  # imported only now, so that it picks up TWILIO_DATA_PATH
+    queries = QueryCounter()
+    storage.CONNECT_HOOKS.append(queries.install)
+    import app as app_module
+    seed(storage.DB_PATH, args, rng)
+    if args.group_commit:
+        storage.enable_group_commit(args.group_commit)
+
+    results = defaultdict(list)
+    per_thread = args.requests // args.threads
+    threads = [threading.Thread(target=run_calls,
+                                args=(app_module.app, per_thread, args, random.Random(args.seed + n), queries,
+                                      results))
+               for n in range(args.threads)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = perf_counter() - start
+    startups = time_startups(args.startup_runs)
+
+    summary = summarize(results, wall_time, startups)
+    for route, stats in summary.items():
+        print('{:<16} {}'.format(route, ', '.join('{}={}'.format(key, value) for key, value in stats.items())))
+
+    report = {
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'environment': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                        'platform': platform.platform()},
+        'results': summary,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print('Saved results to {}.'.format(args.output))
+    shutil.rmtree(directory, ignore_errors=True)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+        if not compare(summary, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Periodic database housekeeping, run on a background thread instead of during requests."""
+import threading
+import traceback
+
+import storage
+
+
+class Maintenance:
+    FIRST_RUN = 60  # seconds after startup, to stay out of the way of the first callers
+    INTERVAL = 60 * 60
+    PRUNE_BATCH = 500
+    VACUUM_PAGES = 1000
+
+    def __init__(self, cookies, logger):
+        self.cookies = cookies
+        self.logger = logger
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the maintenance thread if this process doesn't have one yet."""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='maintenance', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        stop = threading.Event()  # never set; waits without busy-looping
+        stop.wait(self.FIRST_RUN)
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                traceback.print_exc()
+            stop.wait(self.INTERVAL)
+
+    def run_once(self):
+        """Do one round of housekeeping and log what was done. Returns the report."""
+        pruned = self.cookies.prune(self.PRUNE_BATCH)
+        freed, incremental = storage.optimize(self.VACUUM_PAGES)
+        report = {'cookies_pruned': pruned, 'pages_vacuumed': freed}
+        if incremental:
+            self.logger.info('Maintenance: pruned %d expired cookies, vacuumed %d pages, optimized.', pruned, freed)
+        else:
+            self.logger.info('Maintenance: pruned %d expired cookies, optimized. Incremental vacuum is off; '
+                             'run vacuum.py once to enable it.', pruned)
+        return report
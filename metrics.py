@@ -0,0 +1,155 @@
+"""In-process metrics, exposed in the Prometheus text format.
+
+Each thread records into its own dictionaries, so observing a value never takes a lock; `render()` merges every
+thread's values when /metrics is scraped. A thread's values are folded into a shared total when it exits, so servers
+that start a thread per request don't accumulate them. Values are per process, so with several worker processes each one is
+scraped (or summed) separately.
+"""
+import threading
+import types
+import weakref
+from bisect import bisect_left
+from functools import wraps
+from time import perf_counter
+
+# Upper bounds in seconds. Webhooks should answer in milliseconds; the welcome POST can take seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STORAGE_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+
+_histograms = []
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._local = threading.local()
+        self._shards = {}  # id -> {label values: [bucket counts..., count, sum]}, one per live thread
+        self._retired = {}  # the same, summed over threads that have exited
+        self._lock = threading.Lock()  # not taken by observe, except for a thread's first observation
+        _histograms.append(self)
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            token = self._local.token = _ThreadToken()
+            with self._lock:
+                self._shards[id(shard)] = shard
+            weakref.finalize(token, self._retire, shard)
+            return shard
+
+    def _retire(self, shard):
+        """Fold an exited thread's shard into the retired total."""
+        with self._lock:
+            del self._shards[id(shard)]
+            _add_series(self._retired, shard)
+
+    def observe(self, value, *label_values):
+        shard = self._shard()
+        series = shard.get(label_values)
+        if series is None:
+            series = shard[label_values] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1  # an index past the buckets counts toward +Inf only
+        series[-1] += value
+
+    def collect(self):
+        """Return {label values: (cumulative bucket counts, count, sum)} merged across threads."""
+        merged = {}
+        with self._lock:  # so a shard can't be retired while it's being counted
+            _add_series(merged, self._retired)
+            for shard in self._shards.values():
+                _add_series(merged, shard)
+        result = {}
+        for label_values, series in merged.items():
+            cumulative, running = [], 0
+            for count in series[:len(self.buckets)]:
+                running += count
+                cumulative.append(running)
+            count = sum(series[:-1])
+            result[label_values] = (cumulative, count, series[-1])
+        return result
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} histogram'.format(self.name)]
+        for label_values, (cumulative, count, total) in sorted(self.collect().items()):
+            labels = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(self.labels, label_values)]
+            for bound, bucket_count in zip(self.buckets, cumulative):
+                lines.append('{}_bucket{{{}}} {}'.format(self.name, ','.join(labels + ['le="{}"'.format(bound)]),
+                                                         bucket_count))
+            lines.append('{}_bucket{{{}}} {}'.format(self.name, ','.join(labels + ['le="+Inf"']), count))
+            suffix = '{{{}}}'.format(','.join(labels)) if labels else ''
+            lines.append('{}_count{} {}'.format(self.name, suffix, count))
+            lines.append('{}_sum{} {!r}'.format(self.name, suffix, total))
+        return lines
+
+
+class _ThreadToken:
+    """Kept in a thread's local storage only, so it is garbage collected when the thread exits."""
+    __slots__ = ('__weakref__',)
+
+
+def _add_series(total, shard):
+    for label_values, series in shard.copy().items():
+        series = list(series)
+        into = total.setdefault(label_values, [0] * len(series))
+        for i, value in enumerate(series):
+            into[i] += value
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for histogram in _histograms:
+        lines.extend(histogram.render())
+    return '\n'.join(lines) + '\n'
+
+
+REQUEST_LATENCY = Histogram('twilio_request_duration_seconds', 'Time spent handling requests, by route.',
+                            ('route', 'method'))
+STORAGE_LATENCY = Histogram('twilio_storage_call_duration_seconds',
+                            'Time spent in Storage methods, by class and method. Calls made by another Storage '
+                            'method are counted in both.', ('table', 'method'), STORAGE_BUCKETS)
+WELCOME_LATENCY = Histogram('twilio_welcome_post_duration_seconds',
+                            'Time taken by POSTs to the welcome endpoint, by outcome.', ('outcome',))
+
+# Special methods worth timing; the rest (__init__, __repr__, ...) never touch the database per request.
+_STORAGE_DUNDERS = {'__contains__', '__delitem__', '__getitem__', '__iter__', '__len__', '__setitem__'}
+
+
+def instrument_storage(base):
+    """Time every method of `base` and its subclasses, labelled with the class of the instance they're called on.
+
+    Methods returning generators (such as `CallLog.export`) are only timed up to the point they return.
+    """
+    classes, pending = [], [base]
+    while pending:
+        cls = pending.pop()
+        classes.append(cls)
+        pending.extend(cls.__subclasses__())
+    for cls in classes:
+        for name, attribute in list(vars(cls).items()):
+            if not isinstance(attribute, types.FunctionType) or getattr(attribute, '_instrumented', False):
+                continue
+            if name.startswith('__') and name not in _STORAGE_DUNDERS:
+                continue
+            setattr(cls, name, _timed_method(attribute, name))
+
+
+def _timed_method(function, name):
+    @wraps(function)
+    def timed(self, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return function(self, *args, **kwargs)
+        finally:
+            STORAGE_LATENCY.observe(perf_counter() - start, type(self).__name__, name)
+    timed._instrumented = True
+    return timed
@@ -0,0 +1,148 @@
+"""Opt-in SQL profiling: every statement a request runs, with timings and query plans for the slow ones.
+
+`enable()` makes storage open its connections with `ProfilingConnection`, whose cursors time each statement
+(execution plus fetching its rows). Statements are recorded against the request running on the current thread;
+work done on background threads, by the group-commit writer or while streaming a response isn't attributed to any
+request.
+"""
+import sqlite3
+import threading
+from time import perf_counter
+
+import storage
+
+_local = threading.local()
+_threshold = None  # seconds; statements slower than this get an EXPLAIN QUERY PLAN
+
+
+class Statement:
+    __slots__ = ('sql', 'parameters', 'elapsed', 'plan')
+
+    def __init__(self, sql, parameters):
+        self.sql = sql
+        self.parameters = parameters
+        self.elapsed = 0
+        self.plan = None
+
+    def describe(self):
+        text = '[{:.2f} ms] {}'.format(self.elapsed * 1000, ' '.join(self.sql.split()))
+        if self.plan:
+            text += ' (plan: {})'.format('; '.join(self.plan))
+        return text
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    _statement = None
+
+    def _run(self, statement, method, *args):
+        profile = getattr(_local, 'profile', None)
+        if profile is None:
+            self._statement = None
+            return method(*args)
+        self._statement = statement
+        profile.append(statement)
+        return self._timed(method, *args)
+
+    def _timed(self, method, *args):
+        start = perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self._record(perf_counter() - start)
+
+    def _record(self, elapsed):
+        statement = self._statement
+        if statement is None:
+            return
+        was_slow = statement.elapsed > _threshold
+        statement.elapsed += elapsed
+        if not was_slow and statement.elapsed > _threshold:
+            statement.plan = explain(self.connection, statement.sql, statement.parameters)
+
+    def execute(self, sql, parameters=()):
+        return self._run(Statement(sql, parameters), super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        # explained without parameters, which only works if the statement doesn't take any
+        return self._run(Statement(sql, ()), super().executemany, sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self._run(Statement(sql_script, ()), super().executescript, sql_script)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed(super().fetchmany, size or self.arraysize)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+    def __next__(self):
+        return self._timed(super().__next__)
+
+
+class ProfilingConnection(sqlite3.Connection):
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def commit(self):
+        profile = getattr(_local, 'profile', None)
+        if profile is None or not self.in_transaction:
+            return super().commit()
+        statement = Statement('COMMIT', ())
+        profile.append(statement)
+        start = perf_counter()
+        try:
+            return super().commit()
+        finally:
+            statement.elapsed = perf_counter() - start
+
+
+def explain(conn, sql, parameters):
+    """Return the lines of `sql`'s query plan, or None if it can't be explained."""
+    if sql.split(None, 1)[0].upper() not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH'):
+        return None
+    try:
+        rows = sqlite3.Cursor(conn).execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+    except sqlite3.Error:
+        return None
+    return [row[-1] for row in rows]
+
+
+def enable(threshold=0.005):
+    """Profile connections opened from now on, explaining statements that take longer than `threshold` seconds."""
+    global _threshold
+    _threshold = threshold
+    storage.CONNECTION_FACTORY = ProfilingConnection
+
+
+def enabled():
+    return _threshold is not None
+
+
+def start():
+    """Start recording statements for the request on this thread."""
+    _local.profile = []
+
+
+def finish():
+    """Stop recording and return this thread's statements, or None if nothing was being recorded."""
+    profile = getattr(_local, 'profile', None)
+    _local.profile = None
+    return profile
+
+
+def summary(profile):
+    """A short description of `profile`, for a response header."""
+    return 'count={}; time_ms={:.2f}; slow={}'.format(len(profile), sum(s.elapsed for s in profile) * 1000,
+                                                      sum(s.elapsed > _threshold for s in profile))
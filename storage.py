@@ -1,23 +1,204 @@
+import os
+import queue
+import re
 import sqlite3
-from datetime import datetime, timedelta
+import threading
+import traceback
+from collections import OrderedDict, namedtuple
+from datetime import date, datetime, timedelta
+from hashlib import sha256
 from os.path import dirname, join
 from secrets import token_hex
+from time import monotonic
+
+DB_PATH = os.environ.get('TWILIO_DATA_PATH') or join(dirname(__file__), 'twilio_data.sqlite')
+AUDIO_DIR = join(dirname(DB_PATH), 'audio')
+
+# Applied to every new connection. WAL lets readers proceed while a webhook is writing, and NORMAL sync is safe
+# under WAL (a power loss can only roll back the last few commits, never corrupt the file).
+PRAGMAS = {
+    # Only takes effect on a new database, or on an existing one after a full VACUUM (see vacuum.py).
+    # It must come before journal_mode, which initializes a new database file.
+    'auto_vacuum': 'INCREMENTAL',
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 64 * 1024 * 1024,
+}
+
+# Functions called with each new connection, e.g. to install trace callbacks.
+CONNECT_HOOKS = []
+# The class new connections are made with; see profiling.py.
+CONNECTION_FACTORY = sqlite3.Connection
+
+_local = threading.local()
+_writer = None
+_bootstrapped = False
+
+Message = namedtuple('Message', 'id use_text text file_name options audio_hash audio_size audio_modified')
+
+
+def audio_path(audio_hash):
+    return join(AUDIO_DIR, audio_hash + '.mp3')
+
+
+def store_audio(audio):
+    """Write audio to the content-addressed store and return its hash. Identical audio is stored only once."""
+    audio_hash = sha256(audio).hexdigest()
+    path = audio_path(audio_hash)
+    if not os.path.exists(path):
+        os.makedirs(AUDIO_DIR, exist_ok=True)
+        temp_path = '{}.{}.tmp'.format(path, token_hex(4))
+        with open(temp_path, 'wb') as file:
+            file.write(audio)
+        os.replace(temp_path, path)  # atomic, so a half-written file is never served
+    return audio_hash
+
+
+def optimize(vacuum_pages=1000):
+    """Return up to `vacuum_pages` free pages to the filesystem and refresh the query planner's statistics.
+
+    Returns (pages freed, whether incremental vacuum is enabled).
+    """
+    conn = Storage.connection()
+    incremental = conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+    freed = 0
+    if incremental:
+        before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        conn.execute('PRAGMA incremental_vacuum({:d})'.format(vacuum_pages)).fetchall()
+        freed = before - conn.execute('PRAGMA freelist_count').fetchone()[0]
+    conn.execute('PRAGMA analysis_limit = 400')  # keeps ANALYZE cheap on big tables; ignored by old SQLites
+    conn.execute('PRAGMA optimize')  # runs ANALYZE only on tables whose statistics are stale
+    return freed, incremental
+
+
+def configure(**pragmas):
+    """Change the pragmas applied to connections opened from now on."""
+    PRAGMAS.update(pragmas)
+
+
+def enable_group_commit(window=0.05):
+    """Send writes of `GROUP_COMMIT` tables through a shared background writer."""
+    global _writer
+    if _writer is None:
+        _writer = GroupCommitWriter(window)
+    return _writer
+
+
+class GroupCommitWriter:
+    """Commit writes queued by many threads together in one transaction.
+
+    The writer thread waits at most `window` seconds after the first queued write to gather more, so a burst of
+    calls costs one fsync instead of one per call while no write is delayed by more than the window.
+    """
+
+    def __init__(self, window=0.05, max_batch=200):
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = None
+        self._pid = None  # the process the writer thread belongs to
+        self._lock = threading.Lock()
+
+    def _start(self):
+        """Start the writer thread if this process doesn't have one yet.
+
+        Started on first use rather than in __init__: a process forked after import gets a copy of the queue but not
+        the thread that drains it.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()  # anything queued before a fork is the parent's to write
+                threading.Thread(target=self._run, name='group-commit', daemon=True).start()
+                self._pid = os.getpid()
+
+    def flush(self):
+        """Block until everything submitted so far has been committed."""
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def submit(self, query, parameters=()):
+        self._start()
+        self._queue.put((query, parameters))
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            conn = Storage.connection()
+            try:
+                with conn:
+                    for query, parameters in batch:
+                        conn.execute(query, parameters)
+            except sqlite3.Error:
+                # one bad write shouldn't take the rest of the batch with it
+                for query, parameters in batch:
+                    try:
+                        with conn:
+                            conn.execute(query, parameters)
+                    except sqlite3.Error:
+                        traceback.print_exc()
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
 
 
 class Storage:
     TABLE_NAME = None
     TABLE_SCHEMA = ''
+    CHANGES = None  # a SharedGeneration, for tables cached in memory
+    GROUP_COMMIT = False
 
     @staticmethod
     def connection():
-        return sqlite3.connect(join(dirname(__file__), 'twilio_data.sqlite'))
+        """Return this thread's connection, opening it on first use."""
+        conn = getattr(_local, 'connection', None)
+        if conn is None:
+            conn = _local.connection = Storage.new_connection()
+        return conn
+
+    @staticmethod
+    def new_connection():
+        """Open a connection that isn't shared with the rest of the thread. The caller must close it."""
+        conn = sqlite3.connect(DB_PATH, factory=CONNECTION_FACTORY)
+        for name, value in PRAGMAS.items():
+            conn.execute('PRAGMA {} = {}'.format(name, value))
+        for hook in CONNECT_HOOKS:
+            hook(conn)
+        return conn
+
+    @staticmethod
+    def close_connection():
+        """Close this thread's connection, if it has one."""
+        conn = getattr(_local, 'connection', None)
+        if conn is not None:
+            _local.connection = None
+            conn.close()
 
     def __init__(self):
         if self.TABLE_NAME is None:
             raise NotImplementedError('`TABLE_NAME` needs to be specified.')
+        if _bootstrapped:
+            return
         conn = self.connection()
         cursor = conn.cursor()
         cursor.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(self.TABLE_NAME, self.TABLE_SCHEMA))
+        if self.CHANGES is not None:
+            cursor.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(SharedGeneration.TABLE_NAME,
+                                                                       SharedGeneration.TABLE_SCHEMA))
         conn.commit()
 
     def __len__(self):
@@ -40,6 +221,15 @@ class Storage:
         return cursor.execute('SELECT {cols} from {tab} {order}'.format(cols=', '.join(columns), tab=self.TABLE_NAME,
                                                                         order=order_by))
 
+    def _write(self, query, parameters=()):
+        """Run a single write, through the group-commit writer if this table uses it."""
+        if self.GROUP_COMMIT and _writer is not None:
+            _writer.submit(query, parameters)
+            return
+        conn = self.connection()
+        conn.cursor().execute(query, parameters)
+        conn.commit()
+
     def _remove(self, column_name, value):
         conn = self.connection()
         cursor = conn.cursor()
@@ -54,30 +244,289 @@ class Storage:
         conn.commit()
 
 
+class SharedGeneration:
+    """A counter, shared by every process using the database, that tells in-memory caches their table changed.
+
+    Writers bump it in the same transaction as their change. Readers compare it with the value their cache was built
+    from, querying it at most once per CHECK_INTERVAL, so other processes pick up a change within that long.
+    """
+    TABLE_NAME = 'generations'
+    TABLE_SCHEMA = 'name TEXT PRIMARY KEY NOT NULL, value INTEGER NOT NULL'
+    CHECK_INTERVAL = 1  # seconds
+
+    def __init__(self, name):
+        self.name = name
+        self._value = None
+        self._checked = None
+
+    def bump(self, cursor):
+        cursor.execute('INSERT INTO {} (name, value) VALUES (?, 1) '
+                       'ON CONFLICT (name) DO UPDATE SET value = value + 1'.format(self.TABLE_NAME), (self.name,))
+        self._checked = None  # this process should see its own change right away
+
+    def current(self):
+        now = monotonic()
+        if self._checked is None or now - self._checked >= self.CHECK_INTERVAL:
+            row = Storage.connection().execute('SELECT value FROM {} WHERE name=?'.format(self.TABLE_NAME),
+                                               (self.name,)).fetchone()
+            self._value = 0 if row is None else row[0]
+            self._checked = now
+        return self._value
+
+
+def _add_lookup_indexes(cursor):
+    # Twilio can retry a webhook, so drop repeated call SIDs (keeping the first) before making them unique.
+    cursor.execute('DELETE FROM calls WHERE call_sid IS NOT NULL AND id NOT IN '
+                   '(SELECT MIN(id) FROM calls WHERE call_sid IS NOT NULL GROUP BY call_sid)')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS calls_call_sid ON calls (call_sid)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS calls_number ON calls (number)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS cookies_cookie ON cookies (cookie, expiration)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS cookies_expiration ON cookies (expiration)')
+
+
+def _epoch_call_timestamps(cursor):
+    # Calls used to be logged as local `strftime('%c')` strings, which neither sort nor range-scan correctly.
+    rows = cursor.execute("SELECT id, timestamp FROM calls WHERE typeof(timestamp) = 'text'").fetchall()
+    for id_, timestamp in rows:
+        try:
+            epoch = int(datetime.strptime(timestamp, '%c').timestamp())
+        except ValueError:
+            continue
+        cursor.execute('UPDATE calls SET timestamp=? WHERE id=?', (epoch, id_))
+    cursor.execute('CREATE INDEX IF NOT EXISTS calls_timestamp ON calls (timestamp)')
+
+
+def _add_column(cursor, table, column, definition):
+    if column not in (row[1] for row in cursor.execute('PRAGMA table_info({})'.format(table))):
+        cursor.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, definition))
+
+
+def _audio_metadata(cursor):
+    # Lets audio be served with an ETag and Last-Modified without reading the BLOB first.
+    _add_column(cursor, 'coded_messages', 'audio_hash', 'TEXT')
+    _add_column(cursor, 'coded_messages', 'audio_size', 'INTEGER')
+    _add_column(cursor, 'coded_messages', 'audio_modified', 'INTEGER')
+    now = int(datetime.now().timestamp())
+    ids = [row[0] for row in cursor.execute('SELECT id FROM coded_messages WHERE audio IS NOT NULL').fetchall()]
+    for id_ in ids:  # one row at a time, to hold only one recording in memory
+        audio = cursor.execute('SELECT audio FROM coded_messages WHERE id=?', (id_,)).fetchone()[0]
+        cursor.execute('UPDATE coded_messages SET audio_hash=?, audio_size=?, audio_modified=? WHERE id=?',
+                       (sha256(audio).hexdigest(), len(audio), now, id_))
+
+
+def _audio_files(cursor):
+    # Recordings move out of the `audio` BLOB column into the content-addressed store under AUDIO_DIR.
+    ids = [row[0] for row in cursor.execute('SELECT id FROM coded_messages WHERE audio IS NOT NULL').fetchall()]
+    for id_ in ids:
+        audio = cursor.execute('SELECT audio FROM coded_messages WHERE id=?', (id_,)).fetchone()[0]
+        cursor.execute('UPDATE coded_messages SET audio=NULL, audio_hash=?, audio_size=? WHERE id=?',
+                       (store_audio(audio), len(audio), id_))
+
+
+def _welcome_outbox_index(cursor):
+    cursor.execute('CREATE INDEX IF NOT EXISTS welcome_outbox_due ON welcome_outbox (status, next_attempt)')
+
+
+_CALL_CODE_ADDED = '''
+    INSERT OR IGNORE INTO code_caller_stats (code, number, uses) SELECT NEW.code, NEW.number, 0
+        WHERE NEW.code IS NOT NULL;
+    INSERT OR IGNORE INTO code_stats (code, uses, callers) SELECT NEW.code, 0, 0 WHERE NEW.code IS NOT NULL;
+    UPDATE code_stats SET uses = uses + 1, callers = callers +
+        (SELECT uses = 0 FROM code_caller_stats WHERE code = NEW.code AND number = NEW.number)
+        WHERE code = NEW.code;
+    UPDATE code_caller_stats SET uses = uses + 1 WHERE code = NEW.code AND number = NEW.number;
+'''
+
+_CALL_CODE_REMOVED = '''
+    UPDATE code_caller_stats SET uses = uses - 1 WHERE code = OLD.code AND number = OLD.number;
+    UPDATE code_stats SET uses = uses - 1, callers = callers -
+        (SELECT uses = 0 FROM code_caller_stats WHERE code = OLD.code AND number = OLD.number)
+        WHERE code = OLD.code;
+    DELETE FROM code_caller_stats WHERE code = OLD.code AND number = OLD.number AND uses = 0;
+'''
+
+
+def _call_rollups(cursor):
+    # Analytics totals, kept up to date by triggers on `calls` so they also cover batched writes.
+    # Ignored numbers are subtracted when reading, so (un)ignoring a number needs no bookkeeping.
+    cursor.execute('CREATE TABLE call_totals (id INTEGER PRIMARY KEY CHECK (id = 1), calls INTEGER NOT NULL, '
+                   'callers INTEGER NOT NULL)')
+    cursor.execute('CREATE TABLE caller_stats (number TEXT PRIMARY KEY NOT NULL, calls INTEGER NOT NULL)')
+    cursor.execute('CREATE TABLE code_stats (code TEXT PRIMARY KEY NOT NULL, uses INTEGER NOT NULL, '
+                   'callers INTEGER NOT NULL)')
+    cursor.execute('CREATE TABLE code_caller_stats (code TEXT NOT NULL, number TEXT NOT NULL, uses INTEGER NOT NULL, '
+                   'PRIMARY KEY (code, number))')
+    cursor.execute('CREATE INDEX code_caller_stats_number ON code_caller_stats (number)')
+
+    cursor.execute('INSERT INTO caller_stats SELECT number, COUNT(*) FROM calls GROUP BY number')
+    cursor.execute('INSERT INTO call_totals SELECT 1, COALESCE(SUM(calls), 0), COUNT(*) FROM caller_stats')
+    cursor.execute('INSERT INTO code_caller_stats SELECT code, number, COUNT(*) FROM calls WHERE code IS NOT NULL '
+                   'GROUP BY code, number')
+    cursor.execute('INSERT INTO code_stats SELECT code, SUM(uses), COUNT(*) FROM code_caller_stats GROUP BY code')
+
+    cursor.execute('''CREATE TRIGGER calls_rollup_insert AFTER INSERT ON calls BEGIN
+        INSERT OR IGNORE INTO caller_stats (number, calls) VALUES (NEW.number, 0);
+        UPDATE call_totals SET calls = calls + 1,
+            callers = callers + (SELECT calls = 0 FROM caller_stats WHERE number = NEW.number);
+        UPDATE caller_stats SET calls = calls + 1 WHERE number = NEW.number;
+        {}
+    END'''.format(_CALL_CODE_ADDED))
+    cursor.execute('''CREATE TRIGGER calls_rollup_code AFTER UPDATE OF code ON calls WHEN OLD.code IS NOT NEW.code
+    BEGIN
+        {}
+        {}
+    END'''.format(_CALL_CODE_REMOVED, _CALL_CODE_ADDED))
+    cursor.execute('''CREATE TRIGGER calls_rollup_delete AFTER DELETE ON calls BEGIN
+        UPDATE caller_stats SET calls = calls - 1 WHERE number = OLD.number;
+        UPDATE call_totals SET calls = calls - 1,
+            callers = callers - (SELECT calls = 0 FROM caller_stats WHERE number = OLD.number);
+        DELETE FROM caller_stats WHERE number = OLD.number AND calls = 0;
+        {}
+    END'''.format(_CALL_CODE_REMOVED))
+
+
+def _open_hours_overrides(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS open_hours_overrides (date TEXT PRIMARY KEY NOT NULL, opening TIME, '
+                   'closing TIME)')
+
+
+# Each entry upgrades the schema by one version. Append new migrations; never edit or reorder released ones.
+MIGRATIONS = [
+    _add_lookup_indexes,
+    _epoch_call_timestamps,
+    _audio_metadata,
+    _audio_files,
+    _welcome_outbox_index,
+    _call_rollups,
+    _open_hours_overrides,
+]
+
+
+def bootstrap():
+    """Create every table and apply any pending migrations, all in one transaction.
+
+    An up-to-date database costs a single read. Storage objects created afterwards don't touch the database, so
+    call this before creating them.
+    """
+    global _bootstrapped
+    conn = Storage.connection()
+    tables = {}
+    pending = [Storage]
+    while pending:
+        cls = pending.pop()
+        pending.extend(cls.__subclasses__())
+        if cls.TABLE_NAME is not None:
+            tables[cls.TABLE_NAME] = cls.TABLE_SCHEMA
+    tables[SharedGeneration.TABLE_NAME] = SharedGeneration.TABLE_SCHEMA
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if existing.issuperset(tables) and version == len(MIGRATIONS):
+        _bootstrapped = True
+        return
+    conn.execute('BEGIN IMMEDIATE')  # another worker may be bootstrapping too; wait for it, then re-check
+    try:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for name, schema in tables.items():
+            conn.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(name, schema))
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            migration(conn.cursor())
+            conn.execute('PRAGMA user_version = {}'.format(number))
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    _bootstrapped = True
+
+
 class CallLog(Storage):
     TABLE_NAME = 'calls'
-    TABLE_SCHEMA = ('id INTEGER PRIMARY KEY NOT NULL, number TEXT NOT NULL, timestamp DATETIME NOT NULL, '
+    TABLE_SCHEMA = ('id INTEGER PRIMARY KEY NOT NULL, number TEXT NOT NULL, timestamp INTEGER NOT NULL, '
                     'call_sid TEXT, code TEXT, id_number TEXT')
+    GROUP_COMMIT = True
 
     def __iter__(self):
-        return self._iterate_columns('number', 'timestamp', 'code', order_by='ORDER BY timestamp ASC')
+        return self._iterate_columns('number', 'timestamp', 'code', order_by='ORDER BY timestamp ASC, id ASC')
 
     def add(self, number, time, call_sid):
-        conn = self.connection()
-        conn.cursor().execute('INSERT INTO {} (number, timestamp, call_sid) VALUES (?, ?, ?)'.format(
+        """Log a call. `time` is a Unix timestamp."""
+        self._write('INSERT OR IGNORE INTO {} (number, timestamp, call_sid) VALUES (?, ?, ?)'.format(
             self.TABLE_NAME),
             (number, time, call_sid))
-        conn.commit()
 
-    def filter_ignored(self):
-        """Get the numbers that aren't ignored.
+    def _filters(self, number=None, code=None, start=None, end=None):
+        """Build a WHERE clause selecting calls from numbers that aren't ignored.
 
-        Brittle, hardcoded method.
+        `start` and `end` are Unix timestamps bounding the call time as start <= timestamp < end.
+        Returns (clause, parameters).
+        """
+        # NOT EXISTS is answered from the ignored table's primary key index
+        conditions = ['NOT EXISTS (SELECT 1 FROM {ig_tab} WHERE {ig_tab}.number = {tab}.number)'.format(
+            tab=self.TABLE_NAME, ig_tab=Ignored.TABLE_NAME)]
+        parameters = []
+        for condition, value in (('{}.number = ?', number), ('{}.code = ?', code),
+                                 ('{}.timestamp >= ?', start), ('{}.timestamp < ?', end)):
+            if value is not None:
+                conditions.append(condition.format(self.TABLE_NAME))
+                parameters.append(value)
+        return 'WHERE ' + ' AND '.join(conditions), parameters
+
+    def export(self, **filters):
+        """Iterate over calls, oldest first, from numbers that aren't ignored, without loading them all.
+
+        `filters` are passed to `_filters`. Yields (number, contact name, timestamp, code, id_number) rows.
+        The rows are read on a connection of their own, since a streamed response outlives the request's.
+        """
+        where, parameters = self._filters(**filters)
+        conn = self.new_connection()
+        try:
+            yield from conn.execute('SELECT {tab}.number, {con_tab}.name, {tab}.timestamp, {tab}.code, '
+                                    '{tab}.id_number FROM {tab} LEFT JOIN {con_tab} ON {con_tab}.number = {tab}.number '
+                                    '{where} ORDER BY {tab}.timestamp ASC, {tab}.id ASC'.format(
+                                        tab=self.TABLE_NAME, con_tab=Contacts.TABLE_NAME, where=where), parameters)
+        finally:
+            conn.close()
+
+    def page(self, before=None, limit=100, **filters):
+        """Get a page of calls, newest first, from numbers that aren't ignored.
+
+        `before` is the (timestamp, id) of the last call on the previous page. `filters` are passed to `_filters`.
+        Returns up to `limit` (id, number, timestamp, code, id_number, contact name) rows.
         """
+        where, parameters = self._filters(**filters)
+        if before is not None:
+            where += ' AND ({tab}.timestamp < ? OR ({tab}.timestamp = ? AND {tab}.id < ?))'.format(
+                tab=self.TABLE_NAME)
+            parameters += [before[0], before[0], before[1]]
         cursor = self.connection().cursor()
-        return cursor.execute('SELECT number, timestamp, code, id_number FROM {tab} '.format(tab=self.TABLE_NAME) +
-                              'WHERE number not in (SELECT number FROM {ig_tab})'.format(
-                                  ig_tab=Ignored.TABLE_NAME)).fetchall()
+        return cursor.execute('SELECT {tab}.id, {tab}.number, {tab}.timestamp, {tab}.code, {tab}.id_number, '
+                              '{con_tab}.name FROM {tab} LEFT JOIN {con_tab} ON {con_tab}.number = {tab}.number '
+                              '{where} ORDER BY {tab}.timestamp DESC, {tab}.id DESC LIMIT ?'.format(
+                                  tab=self.TABLE_NAME, con_tab=Contacts.TABLE_NAME, where=where),
+                              parameters + [limit]).fetchall()
+
+    def stats(self):
+        """Summarize calls from numbers that aren't ignored, using the rollup tables.
+
+        Returns (total calls, unique callers, {code: (uses, unique callers)}). The cost depends on the number of
+        codes and ignored numbers, not on the length of the call log.
+        """
+        cursor = self.connection().cursor()
+        calls, callers = cursor.execute('SELECT calls, callers FROM call_totals').fetchone()
+        ignored_calls, ignored_callers = cursor.execute(
+            'SELECT COALESCE(SUM(calls), 0), COUNT(*) FROM caller_stats WHERE number IN '
+            '(SELECT number FROM {ig_tab})'.format(ig_tab=Ignored.TABLE_NAME)).fetchone()
+
+        codes = {code: (uses, code_callers) for code, uses, code_callers in
+                 cursor.execute('SELECT code, uses, callers FROM code_stats WHERE uses > 0')}
+        for code, uses, code_callers in cursor.execute(
+                'SELECT code, SUM(uses), COUNT(*) FROM code_caller_stats WHERE number IN '
+                '(SELECT number FROM {ig_tab}) GROUP BY code'.format(ig_tab=Ignored.TABLE_NAME)):
+            total_uses, total_callers = codes[code]
+            if total_uses == uses:
+                del codes[code]
+            else:
+                codes[code] = (total_uses - uses, total_callers - code_callers)
+        return calls - ignored_calls, callers - ignored_callers, codes
 
     def has_called(self, number):
         cursor = self.connection().cursor()
@@ -85,25 +534,198 @@ class CallLog(Storage):
                                    (number,)).fetchone())
 
     def set_code(self, call_sid, code):
-        conn = self.connection()
-        conn.cursor().execute('UPDATE {} SET code=? WHERE call_sid=?'.format(self.TABLE_NAME), (code, call_sid))
-        conn.commit()
+        self._write('UPDATE {} SET code=? WHERE call_sid=?'.format(self.TABLE_NAME), (code, call_sid))
 
     def set_idnum(self, call_sid, id_number):
+        self._write('UPDATE {} SET id_number=? WHERE call_sid=?'.format(self.TABLE_NAME), (id_number, call_sid))
+
+
+class CallVolume(Storage):
+    """Hourly call counts per code, for the call volume histograms.
+
+    An hour is computed from `calls` once it has closed and cached here, so it is never recomputed. Hours that are
+    still open are counted from `calls` on each request, which the timestamp index keeps cheap. Ignored numbers are
+    included, since they still take up the line.
+    """
+    TABLE_NAME = 'call_volume'
+    TABLE_SCHEMA = 'hour INTEGER NOT NULL, code TEXT NOT NULL, calls INTEGER NOT NULL, PRIMARY KEY (hour, code)'
+    GRACE = 60 * 60  # codes are logged partway through a call, so an hour isn't final the moment it ends
+    _COUNT_HOURS = ("SELECT timestamp / 3600, COALESCE(code, ''), COUNT(*) FROM {tab} "
+                    "WHERE timestamp >= ? AND timestamp < ? AND typeof(timestamp) = 'integer' "
+                    'GROUP BY timestamp / 3600, COALESCE(code, \'\')').format(tab=CallLog.TABLE_NAME)
+
+    def _cache_closed(self, closed):
+        """Count and cache every uncached hour before `closed`."""
         conn = self.connection()
-        conn.cursor().execute('UPDATE {} SET id_number=? WHERE call_sid=?'.format(self.TABLE_NAME),
-                              (id_number, call_sid))
+        cursor = conn.cursor()
+        last = cursor.execute('SELECT MAX(hour) FROM {}'.format(self.TABLE_NAME)).fetchone()[0]
+        if last is None:
+            first_call = cursor.execute("SELECT MIN(timestamp) FROM {} WHERE typeof(timestamp) = 'integer'".format(
+                CallLog.TABLE_NAME)).fetchone()[0]
+            if first_call is None:
+                return
+            start = first_call // 3600
+        else:
+            start = last + 1
+        if start >= closed:
+            return
+        # hours without calls get no row, so a later refresh rescans them; that's an empty index range
+        cursor.execute('INSERT OR REPLACE INTO {} (hour, code, calls) '.format(self.TABLE_NAME) + self._COUNT_HOURS,
+                       (start * 3600, closed * 3600))
         conn.commit()
 
+    def hours(self, start, end, now):
+        """Return (hour, code, calls) rows for hours (since the epoch) in start <= hour < end.
+
+        `code` is '' for calls without one. `now` is the current Unix time.
+        """
+        closed = (now - self.GRACE) // 3600
+        self._cache_closed(closed)
+        cursor = self.connection().cursor()
+        rows = cursor.execute('SELECT hour, code, calls FROM {} WHERE hour >= ? AND hour < ?'.format(
+            self.TABLE_NAME), (start, min(end, closed))).fetchall()
+        if end > closed:
+            rows += cursor.execute(self._COUNT_HOURS, (max(start, closed) * 3600, end * 3600)).fetchall()
+        return rows
+
+
+class CodeRouter:
+    """Finds the stored code that answers the digits a caller entered.
+
+    Besides exact codes, digit patterns are supported: `?` matches any one digit (`5??`), `NNN-MMM` matches any
+    number in that range (`100-199`) and a trailing `*` matches anything starting with the digits before it (`12*`).
+    An exact code wins, then the wildcard pattern with the fewest `?`, then the narrowest range, then the longest
+    prefix, then the default `''` message.
+    """
+    RANGE = re.compile(r'(\d+)-(\d+)')
+    WILDCARD = re.compile(r'[\d?]*\?[\d?]*')
+    PREFIX = re.compile(r'\d*\*')
+
+    def __init__(self, codes):
+        self._exact = set()
+        self._wildcards = {}  # trie over digits and '?'; the None key holds the code ending at a node
+        self._prefixes = {}  # trie over digits; the None key holds the prefix pattern ending at a node
+        self._ranges = []  # (width, low, high, code), narrowest first
+        for code in codes:
+            self._exact.add(code)
+            match = self.RANGE.fullmatch(code)
+            if match and int(match[1]) <= int(match[2]):
+                low, high = int(match[1]), int(match[2])
+                self._ranges.append((high - low, low, high, code))
+            elif self.WILDCARD.fullmatch(code):
+                self._insert(self._wildcards, code, code)
+            elif self.PREFIX.fullmatch(code):
+                self._insert(self._prefixes, code[:-1], code)
+        self._ranges.sort()
+
+    @staticmethod
+    def _insert(trie, path, code):
+        node = trie
+        for char in path:
+            node = node.setdefault(char, {})
+        node[None] = code
+
+    def resolve(self, digits, default=True):
+        """Return the code that answers `digits`, falling back to `''` if `default`, or None if nothing does."""
+        digits = str(digits)
+        if digits in self._exact:
+            return digits
+        if digits.isdigit():
+            code = self._match_wildcard(digits) or self._match_range(digits) or self._match_prefix(digits)
+            if code is not None:
+                return code
+        if default and '' in self._exact:
+            return ''
+        return None
+
+    def _match_wildcard(self, digits):
+        best, best_wildcards = None, len(digits) + 1
+        pending = [(self._wildcards, 0, 0)]  # (node, digits consumed, '?'s used)
+        while pending:
+            node, depth, wildcards = pending.pop()
+            if wildcards >= best_wildcards:
+                continue
+            if depth == len(digits):
+                if None in node:
+                    best, best_wildcards = node[None], wildcards
+                continue
+            if '?' in node:
+                pending.append((node['?'], depth + 1, wildcards + 1))
+            if digits[depth] in node:  # pushed last so exact digits are explored first
+                pending.append((node[digits[depth]], depth + 1, wildcards))
+        return best
+
+    def _match_range(self, digits):
+        number = int(digits)
+        for _, low, high, code in self._ranges:
+            if low <= number <= high:
+                return code
+        return None
+
+    def _match_prefix(self, digits):
+        node, best = self._prefixes, self._prefixes.get(None)
+        for digit in digits:
+            node = node.get(digit)
+            if node is None:
+                break
+            best = node.get(None, best)
+        return best
+
 
 class CodedMessages(Storage):
+    """Messages played for each code.
+
+    Reads go through an in-process copy of every `Message` (audio excluded) and a `CodeRouter` compiled from their
+    codes, so resolving a caller's digits, patterns and default included, costs no queries. Every write rebuilds
+    them, and other processes rebuild theirs when they see `CHANGES` move.
+    """
     TABLE_NAME = 'coded_messages'
     TABLE_SCHEMA = ('id INTEGER PRIMARY KEY NOT NULL, code TEXT NOT NULL UNIQUE, '
                     'use_text TINYINT NOT NULL, text_ TEXT, audio BLOB, file_name TEXT, '
-                    'options INTEGER')
+                    'options INTEGER, audio_hash TEXT, audio_size INTEGER, audio_modified INTEGER')
+    CHANGES = SharedGeneration('coded_messages')
+
+    def __init__(self):
+        super().__init__()
+        self._compiled = None  # (messages by code, router, CHANGES value they were loaded at)
+        self._generation = 0
+        self._lock = threading.Lock()
 
     def __contains__(self, item):
-        return self._contains('code', item)
+        return self._lookup(item) is not None
+
+    def _invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._compiled = None
+        self._load()
+
+    def _load(self):
+        changes = self.CHANGES.current()
+        compiled = self._compiled
+        if compiled is not None and compiled[2] == changes:
+            return compiled
+        generation = self._generation
+        cursor = self.connection().cursor()
+        rows = cursor.execute('SELECT code, id, use_text, text_, file_name, options, audio_hash, audio_size, '
+                              'audio_modified FROM {}'.format(self.TABLE_NAME)).fetchall()
+        messages = {row[0]: Message(row[1], bool(row[2]), *row[3:]) for row in rows}
+        compiled = (messages, CodeRouter(messages), changes)
+        with self._lock:
+            if generation == self._generation:  # a write since we queried would make this stale
+                self._compiled = compiled
+        return compiled
+
+    def _lookup(self, code):
+        """Return the message stored under exactly `code`, or None."""
+        messages, _, _ = self._load()
+        return messages.get(str(code))
+
+    def _message(self, code, default=True):
+        """Return the message that answers `code`, falling back to the default message if `default`."""
+        messages, router, _ = self._load()
+        resolved = router.resolve(code, default)
+        return None if resolved is None else messages[resolved]
 
     def codes(self):
         return self._iterate_column('code')
@@ -111,95 +733,112 @@ class CodedMessages(Storage):
     def delete_reponse(self, code):
         conn = self.connection()
         cursor = conn.cursor()
+        old_hash = self._audio_hash(cursor, code)
         cursor.execute('DELETE FROM {} WHERE code=?'.format(self.TABLE_NAME), (code,))
+        self.CHANGES.bump(cursor)
         conn.commit()
+        self._invalidate()
+        self._release_audio(cursor, old_hash)
 
     def get_options(self, code):
-        cursor = self.connection().cursor()
-        row = cursor.execute('SELECT options FROM {} WHERE code=?'.format(self.TABLE_NAME), (str(code),)).fetchone()
-        if not row:
-            return 0
-        options = row[0]
-        if options is None:
+        message = self._message(code, default=False)  # the default message's options don't apply to other codes
+        if message is None or message.options is None:
             return 0
-        return options
+        return message.options
 
     def get_response_audio(self, code):
         """Returns response audio."""
-        cursor = self.connection().cursor()
-        row = cursor.execute('SELECT audio FROM {} WHERE code=?'.format(self.TABLE_NAME), (str(code),)).fetchone()
-
-        if not row:
-            if code:  # unknown code; revert to default
-                return self.get_response_audio('')
-            else:  # no default case! This should never happen, but just in case...
-                return None
-
-        return row[0]
+        path = self.get_response_audio_path(code)
+        if path is None:
+            return None
+        with open(path, 'rb') as file:
+            return file.read()
+
+    def get_response_audio_info(self, code):
+        """Returns the message whose audio plays for `code`, or None if that message is text."""
+        message = self._message(code)
+        if message is None or message.audio_hash is None:
+            return None
+        return message
+
+    def get_response_audio_path(self, code):
+        """Returns the path of the response audio file."""
+        message = self.get_response_audio_info(code)
+        return None if message is None else audio_path(message.audio_hash)
 
     def get_response_file_name(self, code):
         """Returns response file name."""
-        cursor = self.connection().cursor()
-        row = cursor.execute('SELECT file_name FROM {} WHERE code=?'.format(self.TABLE_NAME), (str(code),)).fetchone()
-
-        if not row:
-            if code:  # unknown code; revert to default
-                return self.get_response_file_name('')
-            else:  # no default case! This should never happen, but just in case...
-                return ''
-
-        return row[0]
+        message = self._message(code)
+        if message is None:  # no default case! This should never happen, but just in case...
+            return ''
+        return message.file_name
 
     def get_response_text(self, code):
         """Returns response text."""
-        cursor = self.connection().cursor()
-        row = cursor.execute('SELECT text_ FROM {} WHERE code=?'.format(self.TABLE_NAME), (str(code),)).fetchone()
-
-        if not row:
-            if code:  # unknown code; revert to default
-                return self.get_response_text('')
-            else:  # no default case!
-                return ''
-
-        return row[0]
+        message = self._message(code)
+        if message is None:  # no default case!
+            return ''
+        return message.text
 
     def get_response_type(self, code):
         """Returns True if the response type is text."""
-        cursor = self.connection().cursor()
-        row = cursor.execute('SELECT use_text FROM {} WHERE code=?'.format(self.TABLE_NAME), (str(code),)).fetchone()
-
-        if not row:
-            if code:  # unknown code; revert to default
-                return self.get_response_type('')
-            else:  # no default case!
-                return True
-
-        return bool(row[0])
+        message = self._message(code)
+        if message is None:  # no default case!
+            return True
+        return message.use_text
 
     def set_audio(self, code, audio, file_name):
+        audio_hash = store_audio(audio)
         conn = self.connection()
         cursor = conn.cursor()
-        cursor.execute('REPLACE INTO {} (code, use_text, audio, file_name) VALUES (?, 0, ?, ?)'.format(self.TABLE_NAME),
-                       (code, audio, file_name))
+        old_hash = self._audio_hash(cursor, code)
+        cursor.execute('REPLACE INTO {} (code, use_text, file_name, audio_hash, audio_size, audio_modified) '
+                       'VALUES (?, 0, ?, ?, ?, ?)'.format(self.TABLE_NAME),
+                       (code, file_name, audio_hash, len(audio), int(datetime.now().timestamp())))
+        self.CHANGES.bump(cursor)
         conn.commit()
+        self._invalidate()
+        self._release_audio(cursor, old_hash)
+
+    def _audio_hash(self, cursor, code):
+        row = cursor.execute('SELECT audio_hash FROM {} WHERE code=?'.format(self.TABLE_NAME), (code,)).fetchone()
+        return row[0] if row else None
+
+    def _release_audio(self, cursor, audio_hash):
+        """Delete an audio file once no message uses it."""
+        if audio_hash is None:
+            return
+        if cursor.execute('SELECT 1 FROM {} WHERE audio_hash=?'.format(self.TABLE_NAME), (audio_hash,)).fetchone():
+            return
+        try:
+            os.remove(audio_path(audio_hash))
+        except FileNotFoundError:
+            pass
 
     def set_options(self, code, options):
         conn = self.connection()
         cursor = conn.cursor()
         cursor.execute('UPDATE {} SET options=? WHERE code=?'.format(self.TABLE_NAME), (options, code))
+        self.CHANGES.bump(cursor)
         conn.commit()
+        self._invalidate()
 
     def set_text(self, code, text):
         conn = self.connection()
         cursor = conn.cursor()
+        old_hash = self._audio_hash(cursor, code)
         cursor.execute('REPLACE INTO {} (code, use_text, text_) VALUES (?, 1, ?)'.format(self.TABLE_NAME),
                        (code, text))
+        self.CHANGES.bump(cursor)
         conn.commit()
+        self._invalidate()
+        self._release_audio(cursor, old_hash)
 
 
 class Config(Storage):
     TABLE_NAME = 'config'
     TABLE_SCHEMA = 'name TEXT PRIMARY KEY NOT NULL, value TEXT'
+    CHANGES = SharedGeneration('config')
 
     def __getitem__(self, item):
         cursor = self.connection().cursor()
@@ -212,6 +851,7 @@ class Config(Storage):
         conn = self.connection()
         cursor = conn.cursor()
         cursor.execute('REPLACE INTO {} VALUES (?, ?)'.format(self.TABLE_NAME), (key, value))
+        self.CHANGES.bump(cursor)
         conn.commit()
 
     def get(self, key, default=None):
@@ -253,17 +893,62 @@ class Contacts(Storage):
         except KeyError:
             return default
 
+    def update(self, contacts):
+        """Store every (number, name) pair from an iterable in one transaction.
+
+        Returns how many contacts were added or renamed; pairs matching an existing contact don't count.
+        """
+        conn = self.connection()
+        cursor = conn.cursor()
+        cursor.executemany('INSERT INTO {} VALUES (?, ?) ON CONFLICT (number) DO UPDATE SET name=excluded.name '
+                           'WHERE name != excluded.name'.format(self.TABLE_NAME), contacts)
+        conn.commit()
+        return cursor.rowcount
+
 
 class Cookies(Storage):
     TABLE_NAME = 'cookies'
     TABLE_SCHEMA = 'id INTEGER PRIMARY KEY NOT NULL, cookie TEXT NOT NULL, expiration DATETIME NOT NULL'
     VALID_LENGTH = timedelta(days=7)
+    CACHE_SIZE = 256
+    CACHE_TTL = 5 * 60  # seconds; a backstop in case a logout's change to `CHANGES` is somehow missed
+    CHANGES = SharedGeneration('cookies')  # moved by logouts, so every process drops its cached checks
+
+    def __init__(self):
+        super().__init__()
+        self._sessions = OrderedDict()  # cookie -> when to stop trusting the cached check, least recently used first
+        self._changes = None  # the CHANGES value _sessions was filled at
+        self._generation = 0
+        self._lock = threading.Lock()
 
     def check(self, cookie):
         """Check if a cookie is valid."""
+        now = int(datetime.now().timestamp())
+        changes = self.CHANGES.current()
+        with self._lock:
+            if changes != self._changes:
+                self._sessions.clear()
+                self._changes = changes
+                self._generation += 1
+            valid_until = self._sessions.get(cookie)
+            if valid_until is not None:
+                if valid_until > now:
+                    self._sessions.move_to_end(cookie)
+                    return True
+                del self._sessions[cookie]
+            generation = self._generation
+
         cursor = self.connection().cursor()
-        return cursor.execute('SELECT * FROM {} WHERE cookie=? AND expiration>?'.format(self.TABLE_NAME),
-                              (cookie, int(datetime.now().timestamp()))).fetchone() is not None
+        row = cursor.execute('SELECT expiration FROM {} WHERE cookie=? AND expiration>?'.format(self.TABLE_NAME),
+                             (cookie, now)).fetchone()
+        if row is None:
+            return False
+        with self._lock:
+            if generation == self._generation:  # don't resurrect a cookie logged out while we were querying
+                self._sessions[cookie] = min(row[0], now + self.CACHE_TTL)
+                if len(self._sessions) > self.CACHE_SIZE:
+                    self._sessions.popitem(last=False)
+        return True
 
     def new(self):
         """Store a new cookie and return it."""
@@ -274,24 +959,64 @@ class Cookies(Storage):
         conn.commit()
         return val
 
-    def prune(self):
-        """Remove cookies that are out-of-date."""
+    def prune(self, batch_size=500):
+        """Remove cookies that are out-of-date, committing every `batch_size` rows. Returns how many were removed.
+
+        Small batches keep the write lock short, so webhooks aren't kept waiting.
+        """
         now = int(datetime.now().timestamp())
         conn = self.connection()
-        conn.cursor().execute('DELETE FROM {} WHERE expiration < ?'.format(self.TABLE_NAME), (now,))
-        conn.commit()
+        cursor = conn.cursor()
+        removed = 0
+        while True:
+            cursor.execute('DELETE FROM {tab} WHERE id IN (SELECT id FROM {tab} WHERE expiration < ? LIMIT ?)'.format(
+                tab=self.TABLE_NAME), (now, batch_size))
+            conn.commit()
+            removed += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                return removed
 
     def remove(self, cookie):
         """Remove a cookie as part of a logout."""
-        self._remove('cookie', cookie)
+        with self._lock:
+            self._generation += 1
+            self._sessions.pop(cookie, None)
+        conn = self.connection()
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM {} WHERE cookie=?'.format(self.TABLE_NAME), (cookie,))
+        if cursor.rowcount:
+            self.CHANGES.bump(cursor)
+        conn.commit()
 
 
 class IdNumbers(Storage):
     TABLE_NAME = 'id_numbers'
     TABLE_SCHEMA = 'id_number TEXT PRIMARY KEY NOT NULL'
+    CHANGES = SharedGeneration('id_numbers')
+
+    def __init__(self, cache=False):
+        """With `cache`, membership tests use an in-memory copy of the table, loaded on first use.
+
+        An ID missing from the copy is still looked up in the table, so one registered by another process is
+        found straight away, so single additions don't move `CHANGES`; removals and bulk imports do, and every
+        process then reloads its copy.
+        """
+        super().__init__()
+        self._cache = cache
+        self._members = None  # (set of IDs, CHANGES value it was loaded at)
+        self._lock = threading.Lock()
 
     def __contains__(self, item):
-        return self._contains('id_number', item)
+        if not self._cache:
+            return bool(self._contains('id_number', item))
+        changes = self.CHANGES.current()
+        members = self._members
+        if members is None or members[1] != changes:
+            with self._lock:
+                members = self._members
+                if members is None or members[1] != changes:
+                    members = self._members = (set(self), changes)
+        return item in members[0] or bool(self._contains('id_number', item))
 
     def __iter__(self):
         return self._iterate_column('id_number')
@@ -299,11 +1024,31 @@ class IdNumbers(Storage):
     def add(self, id_number):
         """Perform a set-style addition"""
         conn = self.connection()
-        conn.cursor().execute('INSERT OR IGNORE INTO {} VALUES (?)'.format(self.TABLE_NAME), (id_number,))
+        cursor = conn.cursor()
+        cursor.execute('INSERT OR IGNORE INTO {} VALUES (?)'.format(self.TABLE_NAME), (id_number,))
         conn.commit()
+        if self._members is not None:
+            with self._lock:
+                self._members[0].add(id_number)
+
+    def add_many(self, id_numbers):
+        """Add every ID from an iterable in one transaction. Returns how many weren't already present."""
+        conn = self.connection()
+        cursor = conn.cursor()
+        cursor.executemany('INSERT OR IGNORE INTO {} VALUES (?)'.format(self.TABLE_NAME),
+                           ((id_number,) for id_number in id_numbers))
+        added = cursor.rowcount
+        if added:
+            self.CHANGES.bump(cursor)  # so a big import is loaded once, not looked up an ID at a time
+        conn.commit()
+        return added
 
     def remove(self, number):
-        self._remove('id_number', number)
+        conn = self.connection()
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM {} WHERE id_number=?'.format(self.TABLE_NAME), (number,))
+        self.CHANGES.bump(cursor)
+        conn.commit()
 
 
 class Ignored(Storage):
@@ -322,13 +1067,66 @@ class Ignored(Storage):
         conn.cursor().execute('INSERT OR IGNORE INTO {} VALUES (?)'.format(self.TABLE_NAME), (number,))
         conn.commit()
 
+    def add_many(self, numbers):
+        """Add every number from an iterable in one transaction. Returns how many weren't already present."""
+        conn = self.connection()
+        cursor = conn.cursor()
+        cursor.executemany('INSERT OR IGNORE INTO {} VALUES (?)'.format(self.TABLE_NAME),
+                           ((number,) for number in numbers))
+        conn.commit()
+        return cursor.rowcount
+
     def remove(self, number):
         self._remove('number', number)
 
 
+class Schedule:
+    """Open hours compiled for lookups that need no database access.
+
+    Days without hours count as open all day. Overrides replace the weekly hours on a single date; an override
+    without hours means closed all day.
+    """
+
+    def __init__(self, weekly, overrides):
+        self._weekly = {weekday: (_minutes(opening), _minutes(closing)) for weekday, opening, closing in weekly}
+        self._overrides = {}
+        for day, opening, closing in overrides:
+            try:
+                self._overrides[date.fromisoformat(day)] = (_minutes(opening), _minutes(closing))
+            except ValueError:  # saved before dates were validated; ignore it rather than fail every call
+                continue
+
+    def is_open(self, now):
+        """Whether the line is open at `now`, an aware datetime in the line's time zone."""
+        today = now.date()
+        if today in self._overrides:
+            opening, closing = self._overrides[today]
+            if opening is None:  # closed all day
+                return False
+        else:
+            opening, closing = self._weekly.get(now.weekday(), (None, None))
+            if None in (opening, closing):
+                return True
+        return opening <= now.hour * 60 + now.minute < closing
+
+
+def _minutes(time):
+    """Convert 'HH:MM' to minutes after midnight."""
+    if time is None:
+        return None
+    return int(time[:2]) * 60 + int(time[3:])
+
+
 class OpenHours(Storage):
+    """Weekly open hours, plus per-date overrides (kept in `open_hours_overrides`) for holidays and closures."""
     TABLE_NAME = 'open_hours'
     TABLE_SCHEMA = 'weekday NUMBER NOT NULL UNIQUE, opening TIME NOT NULL, closing TIME NOT NULL'
+    OVERRIDES_TABLE_NAME = 'open_hours_overrides'
+    CHANGES = SharedGeneration('open_hours')
+
+    def __init__(self):
+        super().__init__()
+        self._schedule = None  # (Schedule, CHANGES value it was built at)
 
     def __iter__(self):
         return self._iterate_columns('weekday', 'opening', 'closing', order_by='ORDER BY weekday ASC')
@@ -339,23 +1137,59 @@ class OpenHours(Storage):
                               (day,)).fetchone()
         return resp or (None, None)
 
+    def overrides(self):
+        """Iterate over (date, opening, closing) overrides by date. Closed days have no opening or closing."""
+        cursor = self.connection().cursor()
+        return cursor.execute('SELECT date, opening, closing FROM {} ORDER BY date ASC'.format(
+            self.OVERRIDES_TABLE_NAME))
+
+    def remove_override(self, day):
+        conn = self.connection()
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM {} WHERE date=?'.format(self.OVERRIDES_TABLE_NAME), (day,))
+        self.CHANGES.bump(cursor)
+        conn.commit()
+        self._schedule = None
+
+    def schedule(self):
+        """Return the compiled Schedule. It is only rebuilt after the hours change, in this process or another."""
+        changes = self.CHANGES.current()
+        cached = self._schedule
+        if cached is None or cached[1] != changes:
+            cached = self._schedule = (Schedule(list(self), list(self.overrides())), changes)
+        return cached[0]
+
     def set(self, opens, closes):
         conn = self.connection()
         cursor = conn.cursor()
         for day in range(7):
             cursor.execute('REPLACE INTO {} (weekday, opening, closing) VALUES (?, ?, ?)'.format(self.TABLE_NAME),
                            (day, opens[day], closes[day]))
+        self.CHANGES.bump(cursor)
         conn.commit()
+        self._schedule = None
+
+    def set_override(self, day, opening=None, closing=None):
+        """Set the hours for one date ('YYYY-MM-DD'). Without hours, the line is closed all that day."""
+        conn = self.connection()
+        cursor = conn.cursor()
+        cursor.execute('REPLACE INTO {} (date, opening, closing) VALUES (?, ?, ?)'.format(
+            self.OVERRIDES_TABLE_NAME), (day, opening, closing))
+        self.CHANGES.bump(cursor)
+        conn.commit()
+        self._schedule = None
 
 
 class Secrets(Storage):
     TABLE_NAME = 'secrets'
     TABLE_SCHEMA = 'name TEXT PRIMARY KEY NOT NULL, value TEXT'
+    CHANGES = SharedGeneration('secrets')
 
     def __delitem__(self, key):
         conn = self.connection()
         cursor = conn.cursor()
         cursor.execute('DELETE FROM {} WHERE name=?'.format(self.TABLE_NAME), (key,))
+        self.CHANGES.bump(cursor)
         conn.commit()
 
     def __getitem__(self, item):
@@ -369,6 +1203,7 @@ class Secrets(Storage):
         conn = self.connection()
         cursor = conn.cursor()
         cursor.execute('REPLACE INTO {} VALUES (?, ?)'.format(self.TABLE_NAME), (key, value))
+        self.CHANGES.bump(cursor)
         conn.commit()
 
     def get(self, key, default=None):
@@ -376,3 +1211,55 @@ class Secrets(Storage):
             return self[key]
         except KeyError:
             return default
+
+
+class WelcomeOutbox(Storage):
+    """Welcome messages waiting to be sent. Rows are deleted once sent; `dead` rows ran out of attempts."""
+    TABLE_NAME = 'welcome_outbox'
+    TABLE_SCHEMA = ('id INTEGER PRIMARY KEY NOT NULL, phone_num TEXT NOT NULL, status TEXT NOT NULL, '
+                    'attempts INTEGER NOT NULL, next_attempt INTEGER NOT NULL, last_error TEXT')
+
+    def add(self, phone_num):
+        conn = self.connection()
+        conn.cursor().execute('INSERT INTO {} (phone_num, status, attempts, next_attempt) '
+                              "VALUES (?, 'pending', 0, ?)".format(self.TABLE_NAME),
+                              (phone_num, int(datetime.now().timestamp())))
+        conn.commit()
+
+    def claim(self, id_, next_attempt, lease_until):
+        """Take a due message for sending. Returns False if another worker got to it first."""
+        conn = self.connection()
+        cursor = conn.cursor()
+        cursor.execute('UPDATE {} SET next_attempt=? WHERE id=? AND next_attempt=?'.format(self.TABLE_NAME),
+                       (lease_until, id_, next_attempt))
+        conn.commit()
+        return cursor.rowcount == 1
+
+    def dead(self):
+        """Messages that ran out of attempts, as (phone number, attempts, last error) rows."""
+        cursor = self.connection().cursor()
+        return cursor.execute("SELECT phone_num, attempts, last_error FROM {} WHERE status='dead' "
+                              'ORDER BY id ASC'.format(self.TABLE_NAME))
+
+    def due(self, now, limit=100):
+        cursor = self.connection().cursor()
+        return cursor.execute("SELECT id, phone_num, attempts, next_attempt FROM {} WHERE status='pending' "
+                              'AND next_attempt<=? ORDER BY next_attempt LIMIT ?'.format(self.TABLE_NAME),
+                              (now, limit)).fetchall()
+
+    def failed(self, id_, error, retry_at=None):
+        """Record a failed attempt. Without `retry_at`, the message is dead-lettered."""
+        conn = self.connection()
+        conn.cursor().execute('UPDATE {} SET attempts=attempts+1, last_error=?, status=?, next_attempt=? '
+                              'WHERE id=?'.format(self.TABLE_NAME),
+                              (error, 'pending' if retry_at else 'dead', retry_at or 0, id_))
+        conn.commit()
+
+    def next_due(self):
+        """Return when the next pending message is due, or None if there are none."""
+        cursor = self.connection().cursor()
+        return cursor.execute("SELECT MIN(next_attempt) FROM {} WHERE status='pending'".format(
+            self.TABLE_NAME)).fetchone()[0]
+
+    def sent(self, id_):
+        self._remove('id', id_)
@@ -0,0 +1,118 @@
+import os
+import tempfile
+import unittest
+
+import storage
+from storage import CodedMessages, CodeRouter, SharedGeneration
+
+
+class CodeRouterPrecedenceTest(unittest.TestCase):
+    def resolve(self, codes, digits, default=True):
+        return CodeRouter(codes).resolve(digits, default)
+
+    def test_exact_code_beats_patterns(self):
+        self.assertEqual(self.resolve(['', '517', '5??', '500-599', '5*'], '517'), '517')
+
+    def test_fewest_wildcards_win(self):
+        self.assertEqual(self.resolve(['', '5??', '5?7'], '517'), '5?7')
+        self.assertEqual(self.resolve(['', '5??', '5?7'], '518'), '5??')
+
+    def test_wildcards_with_as_many_question_marks_prefer_earlier_exact_digits(self):
+        self.assertEqual(self.resolve(['', '5?7', '51?'], '517'), '51?')
+
+    def test_wildcards_match_only_their_own_length(self):
+        codes = ['', '5??']
+        self.assertEqual(self.resolve(codes, '51'), '')
+        self.assertEqual(self.resolve(codes, '5123'), '')
+
+    def test_narrowest_overlapping_range_wins(self):
+        codes = ['', '100-199', '150-160']
+        self.assertEqual(self.resolve(codes, '155'), '150-160')
+        self.assertEqual(self.resolve(codes, '120'), '100-199')
+        self.assertEqual(self.resolve(codes, '200'), '')
+
+    def test_range_bounds_are_inclusive(self):
+        codes = ['', '100-199']
+        self.assertEqual(self.resolve(codes, '100'), '100-199')
+        self.assertEqual(self.resolve(codes, '199'), '100-199')
+
+    def test_wildcard_beats_range_and_range_beats_prefix(self):
+        codes = ['', '1?5', '100-199', '1*']
+        self.assertEqual(self.resolve(codes, '105'), '1?5')
+        self.assertEqual(self.resolve(codes, '106'), '100-199')
+        self.assertEqual(self.resolve(codes, '1060'), '1*')
+
+    def test_longest_prefix_wins(self):
+        codes = ['', '12*', '123*']
+        self.assertEqual(self.resolve(codes, '1234'), '123*')
+        self.assertEqual(self.resolve(codes, '129'), '12*')
+        self.assertEqual(self.resolve(codes, '12'), '12*')
+        self.assertEqual(self.resolve(codes, '13'), '')
+
+    def test_bare_star_matches_any_digits_last(self):
+        codes = ['', '*', '9?']
+        self.assertEqual(self.resolve(codes, '91'), '9?')
+        self.assertEqual(self.resolve(codes, '4'), '*')
+        self.assertEqual(self.resolve(codes, 'abc'), '')
+
+    def test_non_digits_fall_back_to_default(self):
+        codes = ['', '5??', '100-199', '1*']
+        self.assertEqual(self.resolve(codes, 'abc'), '')
+        self.assertEqual(self.resolve(codes, '1#'), '')
+        self.assertEqual(self.resolve(codes, ''), '')
+
+    def test_no_default(self):
+        self.assertIsNone(self.resolve(['', '5??'], '7', default=False))
+        self.assertIsNone(self.resolve(['5??'], '7'))
+
+    def test_named_codes_only_match_exactly(self):
+        codes = ['', 'prompt', 'id-prompt', '1-2']
+        self.assertEqual(self.resolve(codes, 'id-prompt'), 'id-prompt')
+        self.assertEqual(self.resolve(codes, 'prompt'), 'prompt')
+        self.assertEqual(self.resolve(codes, '2'), '1-2')
+
+    def test_reversed_range_is_only_an_exact_code(self):
+        codes = ['', '9-1']
+        self.assertEqual(self.resolve(codes, '5'), '')
+        self.assertEqual(self.resolve(codes, '9-1'), '9-1')
+
+
+class CodedMessagesRoutingTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_path, self.audio_dir = storage.DB_PATH, storage.AUDIO_DIR
+        storage.DB_PATH = os.path.join(self.directory.name, 'twilio_data.sqlite')
+        storage.AUDIO_DIR = os.path.join(self.directory.name, 'audio')
+        self.check_interval = SharedGeneration.CHECK_INTERVAL
+        SharedGeneration.CHECK_INTERVAL = 0
+
+    def tearDown(self):
+        storage.Storage.close_connection()
+        storage.DB_PATH, storage.AUDIO_DIR = self.db_path, self.audio_dir
+        SharedGeneration.CHECK_INTERVAL = self.check_interval
+        self.directory.cleanup()
+
+    def test_patterns_and_fallback(self):
+        coded = CodedMessages()
+        coded.set_text('', 'default')
+        coded.set_text('5??', 'five hundreds')
+        coded.set_options('5??', 1)
+        self.assertEqual(coded.get_response_text('512'), 'five hundreds')
+        self.assertEqual(coded.get_options('512'), 1)
+        self.assertEqual(coded.get_response_text('7'), 'default')
+        self.assertEqual(coded.get_options('7'), 0)  # the default message's options aren't inherited
+
+    def test_router_is_rebuilt_after_another_instance_writes(self):
+        # Each instance stands in for a worker process, with its own router and its own view of the generation.
+        first, second = CodedMessages(), CodedMessages()
+        second.CHANGES = SharedGeneration(CodedMessages.CHANGES.name)
+        first.set_text('', 'default')
+        self.assertEqual(second.get_response_text('512'), 'default')
+        first.set_text('5??', 'five hundreds')
+        self.assertEqual(second.get_response_text('512'), 'five hundreds')
+        first.delete_reponse('5??')
+        self.assertEqual(second.get_response_text('512'), 'default')
+
+
+if __name__ == '__main__':
+    unittest.main()
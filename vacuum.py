@@ -0,0 +1,7 @@
+from storage import Storage
+
+if __name__ == '__main__':
+    # Rebuilds the whole file, which also applies auto_vacuum=INCREMENTAL to a database created before it was set.
+    # Webhooks will wait on this, so run it when the line is quiet.
+    Storage.connection().execute('VACUUM')
+    print('Vacuumed.')
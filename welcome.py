@@ -0,0 +1,106 @@
+"""Background delivery of welcome messages to first-time callers.
+
+Messages are queued in the `welcome_outbox` table, so the webhook never waits on the welcome endpoint and nothing
+is lost if the process restarts. A worker thread sends them, retrying failures with exponential backoff until
+they are dead-lettered.
+"""
+import threading
+import traceback
+from datetime import datetime
+from time import perf_counter
+
+from metrics import WELCOME_LATENCY
+
+
+class WelcomeSender:
+    TIMEOUT = (3.05, 10)  # (connect, read) seconds
+    MAX_ATTEMPTS = 8
+    BASE_DELAY = 30  # seconds before the first retry; doubles each attempt
+    MAX_DELAY = 60 * 60
+    LEASE = 60  # seconds a claimed message is hidden from other workers
+    IDLE_WAIT = 5 * 60  # how long to sleep when nothing is pending, in case another process queued something
+
+    def __init__(self, outbox, secrets):
+        self.outbox = outbox
+        self.secrets = secrets
+        self._session = None  # made when the first message is sent
+        self._thread = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    def enqueue(self, phone_num):
+        """Queue a welcome message and wake the worker."""
+        self.outbox.add(phone_num)
+        self.start()
+        self._wake.set()
+
+    def start(self):
+        """Start the worker thread if this process doesn't have one yet."""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='welcome-sender', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                wait = self.send_due()
+            except Exception:
+                traceback.print_exc()
+                wait = self.BASE_DELAY
+            self._wake.wait(wait)
+
+    def _settings(self):
+        try:
+            settings = (self.secrets['welcome_url'],
+                        self.secrets['welcome_exchange_name'],
+                        self.secrets['welcome_system_password'])
+        except KeyError:
+            return None
+        if not all(settings):
+            return None
+        return settings
+
+    def send_due(self):
+        """Try every message that is due. Returns how many seconds to wait before trying again."""
+        started = int(datetime.now().timestamp())
+        settings = self._settings()
+        for id_, phone_num, attempts, next_attempt in self.outbox.due(started):
+            # POSTs to a slow endpoint add up, so each lease starts when its message is claimed, not with the batch
+            now = int(datetime.now().timestamp())
+            if now - started >= self.LEASE:
+                break  # the rest of the batch may have been claimed elsewhere since; look again on the next pass
+            if not self.outbox.claim(id_, next_attempt, now + self.LEASE):
+                continue
+            if settings is None:  # welcome messages are turned off
+                self.outbox.sent(id_)
+                continue
+            import requests  # slow to import, so not until there is something to send
+            if self._session is None:
+                self._session = requests.Session()
+            url, exchange, password = settings
+            start = perf_counter()
+            try:
+                resp = self._session.post(url, data={'phone_num': phone_num,
+                                                     'exchange': exchange,
+                                                     'password': password},
+                                          timeout=self.TIMEOUT)
+                resp.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                WELCOME_LATENCY.observe(perf_counter() - start, 'error')
+                attempts += 1
+                retry_at = None
+                if attempts < self.MAX_ATTEMPTS:
+                    delay = min(self.BASE_DELAY * 2 ** (attempts - 1), self.MAX_DELAY)
+                    retry_at = int(datetime.now().timestamp()) + delay
+                self.outbox.failed(id_, str(e), retry_at)
+            else:
+                WELCOME_LATENCY.observe(perf_counter() - start, 'ok')
+                self.outbox.sent(id_)
+        next_due = self.outbox.next_due()
+        if next_due is None:
+            return self.IDLE_WAIT
+        return max(0, next_due - int(datetime.now().timestamp()))